@@ -7,14 +7,15 @@ import json
 from vllm import LLM
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
+import numpy as np
 
 from clm_predict import predict_for_dataset, MODEL_INSTRUCTION_TEMPLATES
+from generation_cache import GenerationCache, GenerationLog
 from nlstruct import BRATDataset
-from nlstruct.metrics import MetricsCollection
 from nlstruct_extensions import HuggingfaceNERDataset, DocumentEntityMetricPerLabel
 from nlstruct.data_utils import sentencize
 from dataset_info import get_dataset_colnames, get_dataset_ner_tags, get_dataset_tag_map, get_dataset_language, get_dataset_specialist_name
-from pred_utils import full_preds_string, get_metrics_string
+from pred_utils import full_preds_string, get_metrics_string, ThresholdSweep
 
 args = argparse.ArgumentParser()
 #MAIN ARGS
@@ -26,16 +27,30 @@ args.add_argument("--model_name", type=str, default="gpt2", help="model name")
 args.add_argument('--no_write_log', dest='write_log', action='store_false')
 args.add_argument('-n', '--n_gpus', type=int, default=1)
 args.add_argument('--transformers', action="store_true")
+args.add_argument('--max_batch_tokens', type=int, default=32768, help="memory budget of a --transformers generation batch, in tokens (prompt and new tokens of every beam)")
+args.add_argument('--num_beams', type=int, default=1, help="beam size of --transformers generation. The default, greedy decoding, matches the vLLM first stage and drops the sequences that reached their newline from the batch. Beam search keeps decoding them until the whole batch is done")
+args.add_argument('--verif_scoring', type=str, default="generate", choices=["generate", "logits"], help="self verification by generating the answer, or by comparing the yes/no logits in a single forward pass")
+args.add_argument('--verif_threshold', type=float, default=0.5, help="entities whose probability of a yes at verification is lower are rejected")
+args.add_argument('--verif_skip_likelihood', type=float, default=None, help="entities from a first stage output at least this likely (geometric mean of its token probabilities) are not verified")
 args.add_argument('--debug', action="store_true")
 args.add_argument('--log_full_preds', action="store_true")
+args.add_argument('--generation_cache', type=str, default=None, help="sqlite file where deterministic generations are cached across runs")
+args.add_argument('--generation_cache_size', type=int, default=1024, help="size limit of the generation cache, in MB")
+args.add_argument('--checkpoint_dir', type=str, default=None, help="directory where generations are logged as they are done, a run restarted with the same directory skips them")
+args.add_argument('--metric_workers', type=int, default=1, help="number of processes computing the metrics, documents are split between them")
+args.add_argument('--stream_chunk_size', type=int, default=None, help="process sentences by chunks of this size and log partial metrics after each chunk")
 
 #ABLATION ARGS
 args.add_argument('--control', action="store_true")
+args.add_argument('--control_batch_size', type=int, default=8, help="number of sentences decoded together in --control mode")
 args.add_argument('--random_seed', type=int, default=42)
 args.add_argument('-p','--partition_seed', type=int, default=1)
 args.add_argument('-s', '--training_size', type=int, default=100)
 args.add_argument('--listing', action="store_true")
 args.add_argument('--grid_search', action="store_true")
+args.add_argument('--retriever', type=str, default="tfidf", choices=["tfidf", "ivf"], help="how the few-shot demonstrations are retrieved")
+args.add_argument('--max_prompt_tokens', type=int, default=None, help="token budget of a first prompt, the least similar demonstrations are dropped until it fits")
+args.add_argument('--retriever_index_dir', type=str, default=None, help="where to persist the retriever index (ivf only)")
 
 args = args.parse_args()
 random.seed(args.random_seed)
@@ -83,15 +98,17 @@ if args.debug:
     test_dataset = test_dataset[:50]
     args.training_size = 50
 
-metrics = MetricsCollection({
-    "exact": DocumentEntityMetricPerLabel(binarize_tag_threshold=1., binarize_label_threshold=1., add_label_specific_metrics=ner_tags, filter_entities=ner_tags),
-    "partial": DocumentEntityMetricPerLabel(binarize_tag_threshold=1e-5, binarize_label_threshold=1., add_label_specific_metrics=ner_tags, filter_entities=ner_tags),
-})
+#exact and partial matching are evaluated in a single pass over the documents
+metrics = DocumentEntityMetricPerLabel(binarize_tag_threshold={"exact": 1., "partial": 1e-5}, binarize_label_threshold=1., add_label_specific_metrics=ner_tags, filter_entities=ner_tags, n_workers=args.metric_workers)
+#the reference documents are evaluated once per hyperparameter configuration, tokenize them once and for all,
+#then start the metric workers, if any, which inherit the cache and must be forked before the model is loaded
+metrics.cache_words(traindev_dataset_this_seed+test_dataset)
+metrics.start_workers()
 
 ################# MODEL LOADING #################
 if not args.transformers:
     compute_capability = torch.cuda.get_device_capability()
-    llm = LLM(args.model_name, tensor_parallel_size=args.n_gpus, seed=args.random_seed, dtype="float16" if compute_capability[0]<8 else "auto", trust_remote_code=True)
+    llm = LLM(args.model_name, tensor_parallel_size=args.n_gpus, seed=args.random_seed, dtype="float16" if compute_capability[0]<8 else "auto", trust_remote_code=True, enable_prefix_caching=True)
     tokenizer = None
     model = None
 else:
@@ -102,6 +119,9 @@ else:
     model = AutoModelForCausalLM.from_pretrained(args.model_name, device_map="auto",torch_dtype=torch.bfloat16)
     model = model.eval()
 
+generation_cache = GenerationCache(args.generation_cache, max_size=args.generation_cache_size*2**20) if args.generation_cache else None
+generation_log = GenerationLog(args.checkpoint_dir) if args.checkpoint_dir else None
+
 model_base_name = os.path.basename(args.model_name)
 
 ################# EXPERIMENT DEFINITION #################
@@ -140,6 +160,11 @@ def run_with_hyper_params(
     res_dict['partition_seed'] = args.partition_seed
     res_dict['random_seed'] = args.random_seed
     res_dict['control'] = args.control
+    res_dict['retriever'] = args.retriever
+    res_dict['max_prompt_tokens'] = args.max_prompt_tokens
+    res_dict['verif_scoring'] = args.verif_scoring
+    res_dict['verif_threshold'] = args.verif_threshold
+    res_dict['verif_skip_likelihood'] = args.verif_skip_likelihood
     res_dict['chat_template'] = MODEL_INSTRUCTION_TEMPLATES[args.model_name] if args.model_name in MODEL_INSTRUCTION_TEMPLATES else ""
     res_dict['ner_tags'] = ner_tags
     res_dict['first_example'] = traindev_dataset_this_seed[0]['text']
@@ -155,15 +180,35 @@ def run_with_hyper_params(
     res_dict['one_step'] = one_step
 
     model_kwargs = {
-        "num_beams": 3,
+        "num_beams": args.num_beams,
         "do_sample": False,
         # "temperature": 0.,
         # "top_p": 0.,
     }
     res_dict.update(model_kwargs)
 
+    #everything is computed chunk by chunk (a single chunk unless streaming) and chunks are then released:
+    #metrics, the threshold sweep over every scored entity (rejected ones included) and the full predictions log
+    sweep = ThresholdSweep(ner_tags)
+    if args.log_full_preds:
+        full_preds_path = os.path.join(script_dir, folder_name)+f'/full_preds_{last_two_dirs}_{model_base_name}_{args.random_seed}_{time_str}.txt'
+        res_dict['full_preds_path'] = full_preds_path
+        full_preds_file = open(full_preds_path, 'w')
+    def on_chunk(chunk):
+        metrics.update(chunk['predictions'], chunk['references'])
+        sweep.update(chunk['candidates'], chunk['references'])
+        if args.log_full_preds:
+            #the outputs of a chunk come tag by tag, as full_preds_string expects them
+            full_preds_file.write(full_preds_string(list(chunk['outputs'].values()), chunk['predictions'], chunk['references'], ner_tags))
+        if args.stream_chunk_size:
+            #in streaming mode, partial metrics are logged as the run goes
+            partial_metrics = metrics.compute()
+            n_done = chunk['start']+len(chunk['predictions'])
+            logger.info(f"Partial metrics after {n_done} sentences: " + ", ".join(f"{metric_name} f1 {float(m['f1']):.3f}" for metric_name, m in partial_metrics.items()))
+    metrics.reset()
+
     logger.info("Generating...")
-    textual_outputs, predicted_dataset, first_prompt_example, second_prompt_example = predict_for_dataset(
+    _, _, first_prompt_example, second_prompt_example = predict_for_dataset(
         llm=llm,
         model=model,
         tokenizer=tokenizer,
@@ -172,11 +217,24 @@ def run_with_hyper_params(
         ner_tags=ner_tags,
         model_name=args.model_name,
         control=args.control,
+        control_batch_size=args.control_batch_size,
+        max_batch_tokens=args.max_batch_tokens,
+        verif_scoring=args.verif_scoring,
+        chunk_size=args.stream_chunk_size,
+        verif_threshold=args.verif_threshold,
+        verif_skip_likelihood=args.verif_skip_likelihood,
+        generation_cache=generation_cache,
+        generation_log=generation_log,
+        on_chunk=on_chunk,
+        collect=False,
         model_kwargs=model_kwargs,
         random_seed=args.random_seed,
         prompt_specialist_name=prompt_specialist_name,
         listing=args.listing,
         list_separator=list_separator,
+        retriever=args.retriever,
+        retriever_index_dir=args.retriever_index_dir,
+        max_prompt_tokens=args.max_prompt_tokens,
         
         #hyperparams
         n_few_shot=n_few_shot,
@@ -193,8 +251,11 @@ def run_with_hyper_params(
     res_dict['first_prompt_example'] = first_prompt_example
     res_dict['second_prompt_example'] = second_prompt_example
 
+    if args.log_full_preds:
+        full_preds_file.close()
+
     logger.info("Evaluating...")
-    metric_dict = metrics(predicted_dataset, test_dataset if test_on_test_set else traindev_dataset_this_seed)
+    metric_dict = metrics.compute()
     for metric_name, metric_values in metric_dict.items():
         for k,v in metric_values.items():
             if not isinstance(v, int) and not isinstance(v, float):
@@ -202,17 +263,13 @@ def run_with_hyper_params(
             metric_dict[metric_name][k] = round(metric_dict[metric_name][k], 3)
     res_dict.update(metric_dict)
     logger.info(get_metrics_string(metric_dict, ner_tags))
+    res_dict['threshold_sweep'] = sweep.compute(np.linspace(0, 1, 21))
+    logger.info("Threshold sweep (exact span match):\n" + "\n".join(f"{t:.2f}    precision: {p}    recall: {r}    f1: {f}" for t, p, r, f in zip(*[res_dict['threshold_sweep'][k] for k in ['thresholds', 'precision', 'recall', 'f1']])))
     assert logfilename is not None #normally it should be defined
     if args.write_log:
         with open(logfilename, 'a') as logfile:
             logfile.write(get_metrics_string(metric_dict, ner_tags))
     
-    if args.log_full_preds:
-        full_preds = full_preds_string(textual_outputs, predicted_dataset, test_dataset if test_on_test_set else traindev_dataset_this_seed, ner_tags)
-        full_preds_path = os.path.join(script_dir, folder_name)+f'/full_preds_{last_two_dirs}_{model_base_name}_{args.random_seed}_{time_str}.txt'
-        res_dict['full_preds_path'] = full_preds_path
-        with open(full_preds_path, 'w') as f:
-            f.write(full_preds)
     if args.write_log:
         res_dict_path = os.path.join(script_dir, folder_name)+f'/res_dict_{last_two_dirs}_{model_base_name}_{args.random_seed}_{time_str}.json'
         with open(res_dict_path, 'w') as f:
@@ -331,8 +388,4 @@ logger.info("Running with the best features on the test set")
 with open(logfilename, 'a') as logfile:
     logfile.write("Running with the best features on the test set\n")
 run_with_hyper_params(test_on_test_set=True, **kept_features)
-
-
-
-    
-
+metrics.close()
@@ -1,11 +1,14 @@
 import os
 import re
+import unicodedata
+import math
+import functools
 import torch
 from tqdm import tqdm
-from sklearn.model_selection import KFold
-from prompt_maker import example2string, make_prompts, get_yes_no_words
-from transformers import StoppingCriteria
-from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
+from prompt_maker import example2string, make_prompts, get_yes_no_words, get_answer_tokens, demonstration_cache, DemonstrationPacker, PromptEncoder
+from generation_cache import ChainedStores
+from hf_generation import PrefixCache, hf_generate, hf_answer_probabilities, constrained_generate
+from transformers import AutoTokenizer, AutoModelForCausalLM
 from vllm import LLM, SamplingParams
 import logging
 import datetime
@@ -25,62 +28,251 @@ def get_prompts_for_model(model_name, prompts):
         return prompts
     return [MODEL_INSTRUCTION_TEMPLATES[model_name].format(prompt) for prompt in prompts]
 
-def validate_sentence(s, begin_tag, end_tag):
-    return (
-        begin_tag*(s.count(end_tag)-s.count(begin_tag))
-        +s
-        +end_tag*(s.count(begin_tag)-s.count(end_tag))
-        )
+def get_prefixes_for_model(model_name, prefixes):
+    if model_name not in MODEL_INSTRUCTION_TEMPLATES:
+        return prefixes
+    return [MODEL_INSTRUCTION_TEMPLATES[model_name].split('{}')[0]+prefix for prefix in prefixes]
 
-def remove_1st_level_ents(s, begin_tag, end_tag):
-    s_res = s
-    for e in get_1st_level_ents(s, begin_tag=begin_tag, end_tag=end_tag):
-        s_res = s_res.replace(begin_tag+e+end_tag, e)
-    return s_res
+def get_fragments_for_model(model_name, fragments):
+    # Same as get_prompts_for_model on prompts given as tuples of fragments, the template is stuck to the first and last ones
+    if model_name not in MODEL_INSTRUCTION_TEMPLATES:
+        return fragments
+    head, tail = MODEL_INSTRUCTION_TEMPLATES[model_name].split('{}')
+    return [(head+f[0],)+f[1:-1]+(f[-1]+tail,) if len(f) > 1 else (head+f[0]+tail,) for f in fragments]
 
-def get_1st_level_ents(s, begin_tag, end_tag):
-    regex_begin_tag = re.escape(begin_tag)
-    regex_end_tag = re.escape(end_tag)
-    return re.findall(regex_begin_tag+f'([^{begin_tag[0]}]*?)'+regex_end_tag, s)
+@functools.lru_cache(maxsize=None)
+def get_tags_regex(begin_tag, end_tag):
+    #the longest tag is tried first, so that a tag that starts like the other one does not shadow it
+    return re.compile('|'.join(re.escape(tag) for tag in sorted({begin_tag, end_tag}, key=len, reverse=True)))
+
+def parse_tagged_sentence(s, begin_tag, end_tag):
+    # Single pass over a sentence where entities are surrounded by begin_tag and end_tag, possibly nested.
+    # Returns the sentence without the tags and the (begin, end) offsets of the entities in it.
+    # An unmatched end tag closes an entity starting at the beginning of the sentence,
+    # an unmatched begin tag opens one ending at its end.
+    text_pieces = []
+    length = 0
+    previous = 0
+    open_entities = []
+    spans = []
+    for match in get_tags_regex(begin_tag, end_tag).finditer(s):
+        text_pieces.append(s[previous:match.start()])
+        length += match.start()-previous
+        previous = match.end()
+        if match.group() == begin_tag:
+            open_entities.append(length)
+        elif open_entities:
+            spans.append((open_entities.pop(), length))
+        else:
+            spans.append((0, length))
+    text_pieces.append(s[previous:])
+    length += len(s)-previous
+    while open_entities:
+        spans.append((open_entities.pop(), length))
+    return ''.join(text_pieces), spans
 
 def get_all_ents(s, begin_tag, end_tag):
-    s = validate_sentence(s, begin_tag=begin_tag, end_tag=end_tag)
-    entities = []
-    entities_this_level = [-1]
-    while len(entities_this_level):
-        entities_this_level = get_1st_level_ents(s, begin_tag=begin_tag, end_tag=end_tag)
-        entities.extend(entities_this_level)
-        s = remove_1st_level_ents(s, begin_tag=begin_tag, end_tag=end_tag)
-    return entities
+    text, spans = parse_tagged_sentence(s, begin_tag=begin_tag, end_tag=end_tag)
+    return [text[begin:end] for begin, end in spans]
+
+def accent_free(s):
+    # s lowercased, decomposed (NFKD) and stripped of its combining marks, e.g. "Fièvre" -> "fievre",
+    # along with the offset in s of each of its characters
+    chars = []
+    offsets = []
+    for k, c in enumerate(s):
+        for d in unicodedata.normalize('NFKD', c.lower()):
+            if not unicodedata.combining(d):
+                chars.append(d)
+                offsets.append(k)
+    return ''.join(chars), offsets
+
+def align_to_reference(ref_sentence, s, resync_window=8, max_resync_distance=64):
+    # Walks the (untagged) generated sentence s along the reference sentence in one pass, and returns for each
+    # character of s the offset of the matching reference character, or -1. Both sentences are compared without
+    # case nor accents. Whitespace and punctuation present on one side only are skipped. On any other mismatch,
+    # the walk resynchronizes on the next occurrence of the upcoming generated characters within max_resync_distance
+    # characters of the reference, or drops the generated character if there is none, so that each character
+    # costs at most one bounded search.
+    ref, ref_offsets = accent_free(ref_sentence)
+    gen, gen_offsets = accent_free(s)
+    mapping = [-1]*len(s)
+    i = j = 0
+    while i < len(ref) and j < len(gen):
+        r, c = ref[i], gen[j]
+        if r == c:
+            #a character decomposed into several ones is mapped by its first one
+            if mapping[gen_offsets[j]] == -1:
+                mapping[gen_offsets[j]] = ref_offsets[i]
+            i += 1
+            j += 1
+        elif c.isspace():
+            j += 1
+        elif r.isspace():
+            i += 1
+        elif not c.isalnum() and not r.isalnum():
+            i += 1
+            j += 1
+        elif not c.isalnum():
+            j += 1
+        elif not r.isalnum():
+            i += 1
+        else:
+            index = ref.find(gen[j:j+resync_window], i+1, i+1+max_resync_distance+resync_window)
+            if index != -1:
+                i = index
+            else:
+                j += 1
+    return mapping
+
+def normalize_entity(e):
+    return ''.join(c for c in accent_free(e)[0] if c.isalnum())
 
 def get_indices(ref_sentence, s, begin_tag, end_tag, list_separator=", ", listing=False):
     if not listing:
         # s is a sentence where all entities are surrounded by begin_tag and end_tag
         entities_indices = []
-        for e in get_all_ents(s, begin_tag=begin_tag, end_tag=end_tag):
+        text, spans = parse_tagged_sentence(s, begin_tag=begin_tag, end_tag=end_tag)
+        mapping = align_to_reference(ref_sentence, text)
+        for begin, end in spans:
+            e = text[begin:end]
+            if not e.strip():
+                continue
+            aligned = [mapping[k] for k in range(begin, end) if mapping[k] != -1]
+            if aligned:
+                index, index_end = aligned[0], aligned[-1]+1
+                if normalize_entity(ref_sentence[index:index_end]) == normalize_entity(e):
+                    entities_indices.append((index, index_end))
+                    continue
+            # the entity was not copied faithfully, fall back to its first occurrence
             index = ref_sentence.find(e)
             if index!=-1:
                 entities_indices.append((index, index+len(e)))
         return list(set(entities_indices))
     else:
-        # s is a list_separator-separated list of entities
+        # s is a list_separator-separated list of entities, a repeated entity is matched to its next occurrence
         entities_indices = []
+        next_start = {}
         for e in s.split(list_separator):
-            index = ref_sentence.find(e)
+            if not e.strip():
+                continue
+            index = ref_sentence.find(e, next_start.get(e, 0))
+            if index==-1:
+                index = ref_sentence.find(e)
             if index!=-1:
                 entities_indices.append((index, index+len(e)))
+                next_start[e] = index+len(e)
         return list(set(entities_indices))
 
-class Newline(StoppingCriteria):
-    def __init__(self, check_start, newline_token):
-        self.check_start = check_start
-        self.newline_token = newline_token
-    
-    def __call__(self, input_ids: torch.LongTensor, score: torch.FloatTensor, **kwargs) -> bool:
-        return self.newline_token in input_ids[0, self.check_start:]
+FIRST_SAMPLING_PARAMS = SamplingParams(
+    best_of=1,
+    stop=['\n'],
+    temperature=0.0,
+    top_k=-1,
+    top_p=1,
+    max_tokens=128,
+)
+VERIF_SAMPLING_PARAMS = SamplingParams(
+    stop=['\n'],
+    temperature=0.0,
+    max_tokens=128,
+    top_k=-1,
+    top_p=1,
+)
+
+def output_likelihood(completion):
+    # Geometric mean of the token probabilities of a vLLM completion, None if the engine did not report them
+    if completion.cumulative_logprob is None or len(completion.token_ids) == 0:
+        return None
+    return math.exp(completion.cumulative_logprob/len(completion.token_ids))
+
+def vllm_prompts(prompts, prompts_ids=None):
+    # vLLM inputs of the prompts: their token ids if given, which the engine then does not tokenize, else their text
+    if prompts_ids is None:
+        return prompts
+    return [{"prompt_token_ids": ids} for ids in prompts_ids]
+
+def generate_first_outputs(llm, model, tokenizer, model_prompts, model_prefixes, prefix_cache, model_kwargs, newline_token, max_batch_tokens, prompts_ids=None):
+    # Returns the first stage outputs and their likelihoods
+    if llm:
+        pre_outputs = llm.generate(vllm_prompts(model_prompts, prompts_ids), FIRST_SAMPLING_PARAMS)
+        return [o.outputs[0].text for o in pre_outputs], [output_likelihood(o.outputs[0]) for o in pre_outputs]
+    return hf_generate(model, tokenizer, model_prompts, model_prefixes, prefix_cache, model_kwargs, newline_token, max_batch_tokens=max_batch_tokens, prompts_ids=prompts_ids)
 
+def get_verif_sampling_params(answer_tokens):
+    # answer_tokens is None when verifying by generation, else the (yes, no) tokens the answer is restricted to
+    if answer_tokens is None:
+        return VERIF_SAMPLING_PARAMS
+    def restrict_to_answers(token_ids, logits):
+        mask = torch.full_like(logits, float('-inf'))
+        mask[answer_tokens] = 0
+        return logits + mask
+    return SamplingParams(max_tokens=1, temperature=0.0, logprobs=2, logits_processors=[restrict_to_answers])
+
+def read_verif_output(completion, yes_no, answer_tokens):
+    # Probability that the verification answer is yes. When generating, it is 0 or 1 depending on whether
+    # the answer says no; when scoring, it is read from the logprobs of the restricted answer tokens.
+    if answer_tokens is None:
+        return 0. if yes_no[1].lower() in completion.text.lower() else 1.
+    logprobs = {token: (logprob.logprob if hasattr(logprob, 'logprob') else logprob) for token, logprob in completion.logprobs[0].items()}
+    yes_tok, no_tok = answer_tokens
+    if yes_tok not in logprobs:
+        return 0.
+    if no_tok not in logprobs:
+        return 1.
+    return 1/(1+math.exp(logprobs[no_tok]-logprobs[yes_tok]))
+
+def get_verif_scores(llm, model, tokenizer, verif_prompts, verif_prefixes, prefix_cache, model_kwargs, newline_token, max_batch_tokens, yes_no, answer_tokens, verif_prompts_ids=None):
+    # Probability that each verified entity is accepted, see read_verif_output
+    if llm:
+        pre_outputs = llm.generate(vllm_prompts(verif_prompts, verif_prompts_ids), get_verif_sampling_params(answer_tokens))
+        return [read_verif_output(o.outputs[0], yes_no, answer_tokens) for o in pre_outputs]
+    if answer_tokens is not None:
+        return hf_answer_probabilities(model, tokenizer, verif_prompts, verif_prefixes, prefix_cache, answer_tokens, max_batch_tokens=max_batch_tokens)
+    verif_outputs, _ = hf_generate(model, tokenizer, verif_prompts, verif_prefixes, prefix_cache, model_kwargs, newline_token, max_batch_tokens=max_batch_tokens)
+    return [0. if yes_no[1].lower() in output.lower() else 1. for output in verif_outputs]
+
+def vllm_two_stage_generate(llm, first_prompts, on_first_output, verif_sampling_params, read_verif, known_first=None, on_verif_output=None, first_prompts_ids=None):
+    # Drives the vLLM engine directly: every first stage prompt is submitted, then as soon as one of them is done,
+    # the verification prompts that on_first_output(index, text, likelihood) returns for it, as (key, prompt) pairs
+    # where each prompt is a text or token ids input (see vllm_prompts).
+    # Continuous batching thus mixes both stages instead of leaving the GPU idle between them.
+    # known_first maps the indices of the first prompts that need not be generated to their (text, likelihood).
+    # Returns the first stage outputs, their likelihoods and a dict mapping each verification key to read_verif(its completion),
+    # which is also passed to on_verif_output(key, value) as soon as it is read.
+    # first_prompts_ids, if given, are the token ids of the first prompts, which the engine then does not tokenize.
+    engine = llm.llm_engine
+    known_first = known_first or {}
+    first_outputs = [None]*len(first_prompts)
+    first_likelihoods = [None]*len(first_prompts)
+    verif_keys = []
+    verif_outputs = {}
+    def first_done(k, text, likelihood):
+        first_outputs[k], first_likelihoods[k] = text, likelihood
+        progress.update(1)
+        for key, verif_prompt in on_first_output(k, text, likelihood):
+            engine.add_request(f"verif-{len(verif_keys)}", verif_prompt, verif_sampling_params)
+            verif_keys.append(key)
+    for k, prompt in enumerate(vllm_prompts(first_prompts, first_prompts_ids)):
+        if k not in known_first:
+            engine.add_request(f"first-{k}", prompt, FIRST_SAMPLING_PARAMS)
+    with tqdm(total=len(first_prompts)) as progress:
+        for k, (text, likelihood) in known_first.items():
+            first_done(k, text, likelihood)
+        while engine.has_unfinished_requests():
+            for request_output in engine.step():
+                if not request_output.finished:
+                    continue
+                stage, k = request_output.request_id.split('-')
+                if stage == "first":
+                    first_done(int(k), request_output.outputs[0].text, output_likelihood(request_output.outputs[0]))
+                else:
+                    verif_outputs[verif_keys[int(k)]] = read_verif(request_output.outputs[0])
+                    if on_verif_output is not None:
+                        on_verif_output(verif_keys[int(k)], verif_outputs[verif_keys[int(k)]])
+    return first_outputs, first_likelihoods, verif_outputs
 
-def predict_for_dataset(
+def iter_predictions(
         llm,
         model,
         tokenizer,
@@ -96,62 +288,89 @@ def predict_for_dataset(
         random_seed,
         listing,
         list_separator,
+        control_batch_size=8,
+        max_batch_tokens=32768,
+        verif_scoring="generate",
+        verif_threshold=0.5,
+        verif_skip_likelihood=None,
+        chunk_size=None,
+        generation_cache=None,
+        generation_log=None,
+        max_prompt_tokens=None,
+        checkpoint_size=1024,
         **kwargs):
+    # Runs the whole prediction pipeline on chunks of chunk_size sentences (all at once by default):
+    # generation for every tag, parsing, then self verification. Yields a dict per chunk holding the
+    # predictions of its sentences, their references and the first stage outputs keyed by prompt index
+    # (prompts are ordered tag by tag), so that nothing but the prompts is kept for the whole dataset.
+    # Every entity gets a score: its probability of a yes at verification, or else the likelihood of the
+    # first stage output it comes from (1 if unknown). Entities scoring below verif_threshold at verification
+    # are removed from the predictions but kept in the chunk 'candidates', for threshold sweeps.
+    # Entities from a first stage output with a likelihood of at least verif_skip_likelihood are not verified.
+    # Deterministic generations are looked up in generation_cache (a GenerationCache) before being computed,
+    # and all generations in generation_log (a GenerationLog), which records them as they are done to resume the run:
+    # generations are then run and logged by batches of checkpoint_size prompts, even within a chunk.
+    # First prompts keep the most similar demonstrations that fit in max_prompt_tokens tokens (all by default).
     if not tokenizer:
         tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side='left')
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token_id = 0
 
     first_prompts = []
+    first_fragments = []
+    #distinct shared prefixes, and for each first prompt the index of its prefix
+    prefixes = []
+    prefix_index = {}
+    prefix_ids = []
     self_verif_templates = {}
+    #first prompts are delivered as token ids, assembled from the ids of their fragments (intro, demonstrations, question),
+    #which the demonstration packer also counts, with the model's instruction template
+    prompt_encoder = PromptEncoder(tokenizer)
+    demonstration_packer = DemonstrationPacker(prompt_encoder, max_prompt_tokens, wrap_fragments=lambda fragments: get_fragments_for_model(model_name, [fragments])[0])
     if testing_data is None:
-        logger.info(f"Making a {len(training_data)}-fold cross validation over the training data for each tag...")
-        for ner_tag in ner_tags:
-            kf = KFold(n_splits=len(training_data), shuffle=False)
-            for i, (train_indices, dev_indices) in enumerate(kf.split(training_data)):
-                dev_dataset = [training_data[i] for i in dev_indices]
-                train_dataset = [training_data[i] for i in train_indices]
-                first_prompts_fold, self_verif_template_fold = make_prompts(
-                    train_dataset,
-                    dev_dataset,
-                    ner_tag,
-                    begin_tag=begin_tag,
-                    end_tag=end_tag,
-                    one_step=one_step,
-                    random_seed=random_seed,
-                    listing=listing,
-                    list_separator=list_separator,
-                    **kwargs
-                )
-                first_prompts.extend(first_prompts_fold)
-                self_verif_templates[ner_tag] = self_verif_template_fold
-            logger.debug("Here is an example of a {} tag prompt :\n{}".format(ner_tag, first_prompts[-1]))
-            logger.debug("Here is an example of a self verification template :\n{}".format(self_verif_templates[ner_tag]))
+        logger.info(f"Making a leave-one-out cross validation over the {len(training_data)} training examples for each tag...")
     else:
         logger.info("{} examples in train set".format(len(training_data)))
         logger.info("{} examples in test set".format(len(testing_data)))
-        for ner_tag in ner_tags:
-            first_prompts_ner_tag, self_verif_template_ner_tag = make_prompts(
-                training_data,
-                testing_data,
-                ner_tag,
-                begin_tag=begin_tag,
-                end_tag=end_tag,
-                one_step=one_step,
-                listing=listing,
-                list_separator=list_separator,
-                random_seed=random_seed,
-                **kwargs
-            )
-            first_prompts.extend(first_prompts_ner_tag)
-            self_verif_templates[ner_tag] = self_verif_template_ner_tag
-            logger.debug("Here is an example of a {} tag prompt :\n{}".format(ner_tag, first_prompts[-1]))
-            logger.debug("Here is an example of a self verification template :\n{}".format(self_verif_templates[ner_tag]))
+    for ner_tag in ner_tags:
+        first_prompts_ner_tag, prefixes_ner_tag, self_verif_templates_ner_tag, fragments_ner_tag = make_prompts(
+            training_data,
+            testing_data,
+            ner_tag,
+            begin_tag=begin_tag,
+            end_tag=end_tag,
+            one_step=one_step,
+            listing=listing,
+            list_separator=list_separator,
+            random_seed=random_seed,
+            demonstration_packer=demonstration_packer,
+            **kwargs
+        )
+        first_prompts.extend(first_prompts_ner_tag)
+        first_fragments.extend(fragments_ner_tag)
+        for prefix in prefixes_ner_tag:
+            if prefix not in prefix_index:
+                prefix_index[prefix] = len(prefixes)
+                prefixes.append(prefix)
+            prefix_ids.append(prefix_index[prefix])
+        #self verification templates of the sentences of this tag, None in one step mode
+        self_verif_templates[ner_tag] = self_verif_templates_ner_tag
+        logger.debug("Here is an example of a {} tag prompt :\n{}".format(ner_tag, first_prompts[-1]))
+        logger.debug("Here is an example of a self verification template :\n{}".format(self_verif_templates[ner_tag][-1] if self_verif_templates[ner_tag] else None))
+    logger.info(f"Demonstration cache: {demonstration_cache.stats()}")
+    logger.info(f"First prompts: {demonstration_packer.stats()}")
     
     reference = testing_data if testing_data is not None else training_data
     newline_token = tokenizer.encode('\n', add_special_tokens=False)[-1]
     eos_token = tokenizer.eos_token_id
     yes_no = get_yes_no_words(prompt_language=kwargs['prompt_language'])
-    # yes_tok = tokenizer.encode(yes_no[0],add_special_tokens=False)[0]
-    # no_tok = tokenizer.encode(yes_no[1],add_special_tokens=False)[0]
+    #long answers start with the entity rather than with yes or no, they can only be verified by generation
+    if verif_scoring == "logits" and not kwargs['prompt_long_answer']:
+        #every verification prompt ends like its template, whatever the sentence and entity
+        verif_template = next((template for ner_tag in ner_tags for template in self_verif_templates[ner_tag] or []), "\n")
+        answer_tokens = get_answer_tokens(tokenizer, get_prompts_for_model(model_name, [verif_template])[0], yes_no)
+    else:
+        answer_tokens = None
     sticked = True
     begin_tag_toks = tokenizer.encode("@@",add_special_tokens=False)
     if sticked:
@@ -160,150 +379,220 @@ def predict_for_dataset(
         end_tag_toks = tokenizer.encode("##",add_special_tokens=False)
     if control:
         entries = tokenizer([example['text'].strip()+'\n' for example in reference], add_special_tokens=False).input_ids
+        if model is None:
+            model = AutoModelForCausalLM.from_pretrained(model_name, device_map="auto")
+    model_prompts = get_prompts_for_model(model_name, first_prompts)
+    model_prefixes = get_prefixes_for_model(model_name, prefixes)
+    #unless the assembled ids differ from tokenizing the whole prompts on the first prompt of a tag
+    model_fragments = get_fragments_for_model(model_name, first_fragments)
+    if any(prompt_encoder.encode(model_fragments[p]) != tokenizer(model_prompts[p]).input_ids for p in range(0, len(model_prompts), max(len(reference), 1))):
+        logger.warning("Token ids assembled from prompt fragments differ from the tokenization of the whole prompts, prompts will be sent as text and may differ by a few tokens from the counted lengths")
+        model_fragments = None
+    prefix_cache = PrefixCache(model, tokenizer) if not llm else None
 
-    
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    outputs = []
-    predictions = [
-        {
-            'doc_id': example['doc_id'],
-            'text': example['text'],
-            'entities': [],
-        }
-        for example in reference
-    ]
-    if not control:
-        model_prompts = get_prompts_for_model(model_name, first_prompts)
-        if llm:
-            sampling_params = SamplingParams(
-                best_of=1,
-                stop=['\n'],
-                temperature=0.0,
-                top_k=-1,
-                top_p=1,
-                max_tokens=128,
-            )
-            pre_outputs = llm.generate(model_prompts, sampling_params)
-            outputs = [o.outputs[0].text for o in pre_outputs]
-        else:
-            outputs = []
-            for i in tqdm(range(0,len(model_prompts))):
-                input_tokens = tokenizer.batch_encode_plus(model_prompts[i:i+1],return_tensors="pt", padding=True)
-                for t in input_tokens:
-                    if torch.is_tensor(input_tokens[t]):
-                        input_tokens[t] = input_tokens[t].to(torch.cuda.current_device())
-                stopping_criteria = [Newline(check_start=len(input_tokens.input_ids[0]), newline_token=newline_token)]
-                generation_config = GenerationConfig.from_dict(model_kwargs)
-                output_batch = model.generate(**input_tokens, stopping_criteria=stopping_criteria, max_new_tokens=128, pad_token_id=tokenizer.pad_token_id, generation_config=generation_config)
-                output_batch = tokenizer.batch_decode(output_batch, skip_special_tokens=True)
-                cropped_outputs = [o[len(model_prompts[i]):] for o in output_batch]
-                outputs.extend(cropped_outputs)
+    #what besides the model and the prompt determines each generation, as part of the cache keys
+    if control:
+        first_settings = {"stage": "control", "sticked": sticked}
+    elif llm:
+        first_settings = {"stage": "first", "backend": "vllm", "sampling": repr(FIRST_SAMPLING_PARAMS)}
     else:
-        model = AutoModelForCausalLM.from_pretrained(model_name, device_map="auto")
-        model_prompts = get_prompts_for_model(model_name, first_prompts)
-        for i in tqdm(range(0,len(first_prompts))):
-            prompt = model_prompts[i]
-            input_ids = tokenizer(prompt, padding=True, return_tensors="pt").input_ids
-            input_ids = input_ids.to(model.device)
-            entry = entries[i%len(reference)]
-
-            nb_open_entites = 0
-            all_generated_ids = []
-            num_new_tokens = 0
-            while input_ids[0,-1] not in [newline_token, eos_token] and len(entry)>1 and num_new_tokens<512:
-                output = model.generate(input_ids,max_new_tokens=1,output_scores=True, return_dict_in_generate=True, **model_kwargs)
-                scores = output.scores
-                next_entry_id = entry[0]
-                if nb_open_entites<=0:
-                    allowed_tokens = torch.tensor([
-                        next_entry_id, 
-                        begin_tag_toks[0],
-                        eos_token,
-                        ]).to(device)
-                else:
-                    allowed_tokens = torch.tensor([next_entry_id, begin_tag_toks[0], end_tag_toks[0]]).to(device)
-                next_scores = scores[0][0][[allowed_tokens]]
-                generated_id = allowed_tokens[torch.argmax(next_scores)]
-                if generated_id in [next_entry_id, eos_token]:
-                    entry = entry[1:]
-                    all_generated_ids = [generated_id]
-                elif generated_id==begin_tag_toks[0]:
-                    nb_open_entites+=1
-                    all_generated_ids = begin_tag_toks
-                    if sticked:
-                        entry = tokenizer.encode("@"+tokenizer.decode(entry), add_special_tokens=False)[1:]
-                else:
-                    nb_open_entites-=1
-                    all_generated_ids = end_tag_toks
-
-                num_new_tokens+=len(all_generated_ids)
-
-                input_ids = torch.cat([input_ids,torch.tensor(all_generated_ids).unsqueeze(0).to(device)], dim=1)
-            output_text = tokenizer.decode(input_ids[0],skip_special_tokens=True).replace(prompt,'').strip()
-            outputs.append(output_text)
-        
-    for i, output in enumerate(outputs):
-        if i//len(reference)>=len(ner_tags):
-            continue
-        predictions[i%len(reference)]['entities'].extend([
-            {
-                'entity_id': 'T{}'.format(len(predictions[i%len(reference)]['entities'])+ent_idx+1),
-                'label': ner_tags[i//len(reference)],
-                'fragments': [
-                    {
-                        'begin': begin,
-                        'end': end,
-                    }],
-                'text': reference[i%len(reference)]['text'][begin:end],
-            }
-            for ent_idx, (begin, end) in enumerate(get_indices(reference[i%len(reference)]['text'], output, begin_tag, end_tag, listing=listing, list_separator=list_separator))
-        ])
-    verif_prompts = []
-    if not one_step:
-        sentences = []
-        addresses = []
-        for i,predicted_example in enumerate(predictions):
-            for pred in predicted_example['entities']:
-                type = pred['label']
-                id = pred['entity_id']
-                prompting_sentence = example2string(predicted_example, type, begin_tag, end_tag, sticked=True, tagged=False, listing=listing)
-                verification_sentence = self_verif_templates[type].format(word=pred['text'], sentence=prompting_sentence)
-                sentences.append(verification_sentence)
-                addresses.append((i,id))
-        verif_prompts = get_prompts_for_model(model_name, sentences)
-        logger.info(f"{len(verif_prompts)} prompts generated for self verification")
-        
-        sampling_params = SamplingParams(
-            stop=['\n'],
-            temperature=0.0,
-            max_tokens=128,
-            top_k=-1,
-            top_p=1,
-        )
-        if llm:
-            pre_outputs = llm.generate(verif_prompts, sampling_params)
-            verif_outputs = [o.outputs[0].text for o in pre_outputs]
-            for i, output in enumerate(verif_outputs):
-                if i < len(addresses):
-                    if yes_no[1].lower() in output.lower():
-                        sent_idx, ent_id = addresses[i]
-                        predictions[sent_idx]['entities'] = [ent for ent in predictions[sent_idx]['entities'] if ent['entity_id']!=ent_id]
+        first_settings = {"stage": "first", "backend": "transformers", "model_kwargs": model_kwargs}
+    verif_settings = {"stage": "verification", "backend": "vllm" if llm else "transformers", "answer_tokens": answer_tokens}
+    if answer_tokens is None:
+        verif_settings["sampling"] = repr(VERIF_SAMPLING_PARAMS) if llm else model_kwargs
+    #sampled generations are only logged to resume the run, never cached for other runs
+    stores = [store for store in (generation_log, generation_cache if llm or not model_kwargs.get('do_sample') else None) if store is not None]
+    generation_store = ChainedStores(stores) if stores else None
+
+    def cached(settings, prompts, generate):
+        # generate(indices) returns the values of the given prompts, only called on the ones not stored yet
+        if generation_store is None:
+            return generate(list(range(len(prompts))))
+        return generation_store.cached(model_name, settings, prompts, generate, batch_size=checkpoint_size if generation_log is not None else None)
+
+    def needs_verification(likelihood):
+        return verif_skip_likelihood is None or likelihood is None or likelihood < verif_skip_likelihood
+
+    def verification_prompt(p, span):
+        # Returns the verification prompt of an entity found by first prompt p, its prefix shared by the sentences of the tag
+        # with the same template (it only has placeholders in its final question), and its fragments for prompt_encoder:
+        # the demonstrations of the template, then the final question.
+        i, ner_tag = p%len(reference), ner_tags[p//len(reference)]
+        prompting_sentence = example2string(reference[i], ner_tag, begin_tag, end_tag, sticked=True, tagged=False, listing=listing)
+        template = self_verif_templates[ner_tag][i]
+        prompt = template.format(word=reference[i]['text'][span[0]:span[1]], sentence=prompting_sentence)
+        question_start = template.rfind('\n', 0, template.index('{'))+1
+        fragments = (prompt[:question_start], prompt[question_start:]) if question_start else (prompt,)
+        return prompt, template[:template.index('{')], fragments
+
+    #vLLM verification prompts are sent as token ids too. There are as many of them as entities found, and they repeat the
+    #demonstrations of their template, which prompt_encoder tokenizes once, so that only their final questions are tokenized
+    #per entity instead of the whole prompts by the engine. Checked as for the first prompts, on a sentence of each tag.
+    encode_verif_prompts = bool(llm) and not one_step and len(reference) > 0
+    if encode_verif_prompts:
+        for p in range(0, len(model_prompts), len(reference)):
+            prompt, _, fragments = verification_prompt(p, (0, len(reference[p%len(reference)]['text'])))
+            if prompt_encoder.encode(get_fragments_for_model(model_name, [fragments])[0]) != tokenizer(get_prompts_for_model(model_name, [prompt])[0]).input_ids:
+                logger.warning("Token ids assembled from verification prompt fragments differ from the tokenization of the whole prompts, verification prompts will be sent as text")
+                encode_verif_prompts = False
+                break
+
+    def verification_prompts_ids(verifications):
+        # Token ids of the model prompts of verification_prompt results, None if they are sent as text
+        if not encode_verif_prompts:
+            return None
+        return [prompt_encoder.encode(fragments) for fragments in get_fragments_for_model(model_name, [fragments for _, _, fragments in verifications])]
+
+    #an empty reference makes no chunk
+    chunk_size = chunk_size or max(len(reference), 1)
+    for chunk_start in range(0, len(reference), chunk_size):
+        chunk_end = min(chunk_start+chunk_size, len(reference))
+        prompt_indices = [t*len(reference)+i for t in range(len(ner_tags)) for i in range(chunk_start, chunk_end)]
+        chunk_prompts = [model_prompts[p] for p in prompt_indices]
+        chunk_prompts_ids = [prompt_encoder.encode(model_fragments[p]) for p in prompt_indices] if model_fragments is not None and not control else None
+        #entity spans found by each first prompt, and verification scores (probability of a yes) keyed by (first prompt, entity index)
+        spans = {}
+        verif_prompts = []
+        verif_scores = {}
+        if llm and not control and not one_step:
+            #both stages go through the vLLM engine together, each verification is submitted as soon as its first prompt is done
+            known_first = {}
+            cached_verif_scores = {}
+            verif_cache_keys = {}
+            #results are stored as they come, by batches to spare disk writes
+            pending = {}
+            def store_result(key, value):
+                pending[key] = value
+                if len(pending) >= 256:
+                    generation_store.put_many(pending)
+                    pending.clear()
+            if generation_store is not None:
+                first_cache_keys = [generation_store.key(model_name, first_settings, prompt) for prompt in chunk_prompts]
+                found = generation_store.get_many(first_cache_keys)
+                known_first = {k: found[key] for k, key in enumerate(first_cache_keys) if key in found}
+            def on_first_output(k, output, likelihood):
+                p = prompt_indices[k]
+                if generation_store is not None and k not in known_first:
+                    store_result(first_cache_keys[k], [output, likelihood])
+                spans[p] = get_indices(reference[p%len(reference)]['text'], output, begin_tag, end_tag, listing=listing, list_separator=list_separator)
+                if not needs_verification(likelihood):
+                    return []
+                verifications = [verification_prompt(p, span) for span in spans[p]]
+                new_verif_prompts = get_prompts_for_model(model_name, [prompt for prompt, _, _ in verifications])
+                new_verif_inputs = vllm_prompts(new_verif_prompts, verification_prompts_ids(verifications))
+                verif_prompts.extend(new_verif_prompts)
+                addresses = [(p, ent_idx) for ent_idx in range(len(new_verif_prompts))]
+                if generation_store is not None:
+                    verif_cache_keys.update((address, generation_store.key(model_name, verif_settings, verif_prompt)) for address, verif_prompt in zip(addresses, new_verif_prompts))
+                    found = generation_store.get_many([verif_cache_keys[address] for address in addresses])
+                    cached_verif_scores.update((address, found[verif_cache_keys[address]]) for address in addresses if verif_cache_keys[address] in found)
+                return [(address, verif_input) for address, verif_input in zip(addresses, new_verif_inputs) if address not in cached_verif_scores]
+            def on_verif_output(address, score):
+                if generation_store is not None:
+                    store_result(verif_cache_keys[address], score)
+            outputs, likelihoods, verif_scores = vllm_two_stage_generate(llm, chunk_prompts, on_first_output, get_verif_sampling_params(answer_tokens), lambda completion: read_verif_output(completion, yes_no, answer_tokens), known_first=known_first, on_verif_output=on_verif_output, first_prompts_ids=chunk_prompts_ids)
+            if generation_store is not None:
+                generation_store.put_many(pending)
+                verif_scores.update(cached_verif_scores)
+            logger.info(f"{len(verif_prompts)} prompts generated for self verification")
         else:
-            batch_size = 4
-            for i in tqdm(range(0,len(verif_prompts),batch_size)):
-                batch = verif_prompts[i:i+batch_size]
-                input_tokens = tokenizer.batch_encode_plus(batch,return_tensors="pt", padding=True)
-                for t in input_tokens:
-                    if torch.is_tensor(input_tokens[t]):
-                        input_tokens[t] = input_tokens[t].to(torch.cuda.current_device())
-                stopping_criteria = [Newline(check_start=len(input_tokens.input_ids[0]), newline_token=newline_token)]
-                generation_config = GenerationConfig.from_dict(model_kwargs)
-                output_batch = model.generate(**input_tokens, stopping_criteria=stopping_criteria, max_new_tokens=128, pad_token_id=tokenizer.pad_token_id, generation_config=generation_config)
-                output_batch = tokenizer.batch_decode(output_batch, skip_special_tokens=True)
-                for j, output in enumerate(output_batch):
-                    if yes_no[1].lower() in output.lower():
-                        sent_idx, ent_id = addresses[i+j]
-                        predictions[sent_idx]['entities'] = [ent for ent in predictions[sent_idx]['entities'] if ent['entity_id']!=ent_id]
-
-    return outputs, predictions, model_prompts[0], (verif_prompts[0] if len(verif_prompts)>0 else None)
-    
\ No newline at end of file
+            if not control:
+                chunk_prefixes = [model_prefixes[prefix_ids[p]] for p in prompt_indices]
+                first = cached(first_settings, chunk_prompts, lambda indices: list(zip(*generate_first_outputs(llm, model, tokenizer, [chunk_prompts[k] for k in indices], [chunk_prefixes[k] for k in indices], prefix_cache, model_kwargs, newline_token, max_batch_tokens, prompts_ids=[chunk_prompts_ids[k] for k in indices] if chunk_prompts_ids is not None else None))))
+                outputs, likelihoods = [output for output, _ in first], [likelihood for _, likelihood in first]
+            else:
+                outputs = cached(first_settings, chunk_prompts, lambda indices: constrained_generate(
+                    model,
+                    tokenizer,
+                    [chunk_prompts[k] for k in indices],
+                    [entries[prompt_indices[k]%len(reference)] for k in indices],
+                    newline_token=newline_token,
+                    eos_token=eos_token,
+                    begin_tag_toks=begin_tag_toks,
+                    end_tag_toks=end_tag_toks,
+                    sticked=sticked,
+                    batch_size=control_batch_size,
+                ))
+                likelihoods = [None]*len(outputs)
+            for p, output in zip(prompt_indices, outputs):
+                spans[p] = get_indices(reference[p%len(reference)]['text'], output, begin_tag, end_tag, listing=listing, list_separator=list_separator)
+            if not one_step:
+                addresses = [(p, ent_idx) for p, likelihood in zip(prompt_indices, likelihoods) if needs_verification(likelihood) for ent_idx in range(len(spans[p]))]
+                verifications = [verification_prompt(p, spans[p][ent_idx]) for p, ent_idx in addresses]
+                verif_prompts = get_prompts_for_model(model_name, [prompt for prompt, _, _ in verifications])
+                logger.info(f"{len(verif_prompts)} prompts generated for self verification")
+                verif_prefixes = get_prefixes_for_model(model_name, [prefix for _, prefix, _ in verifications])
+                verif_prompts_ids = verification_prompts_ids(verifications)
+                verif_scores = dict(zip(addresses, cached(verif_settings, verif_prompts, lambda indices: get_verif_scores(llm, model, tokenizer, [verif_prompts[k] for k in indices], [verif_prefixes[k] for k in indices], prefix_cache, model_kwargs, newline_token, max_batch_tokens, yes_no, answer_tokens, verif_prompts_ids=[verif_prompts_ids[k] for k in indices] if verif_prompts_ids is not None else None))))
+
+        #every entity of the chunk keyed by (sentence index in the chunk, entity id), and the keys of the rejected ones
+        entities = {}
+        entity_ids = {}
+        n_entities = [0]*(chunk_end-chunk_start)
+        for p, likelihood in zip(prompt_indices, likelihoods):
+            i = p%len(reference)
+            for ent_idx, (begin, end) in enumerate(spans[p]):
+                n_entities[i-chunk_start] += 1
+                entity_ids[(p, ent_idx)] = (i-chunk_start, 'T{}'.format(n_entities[i-chunk_start]))
+                entities[entity_ids[(p, ent_idx)]] = {
+                    'entity_id': entity_ids[(p, ent_idx)][1],
+                    'label': ner_tags[p//len(reference)],
+                    'fragments': [
+                        {
+                            'begin': begin,
+                            'end': end,
+                        }],
+                    'text': reference[i]['text'][begin:end],
+                    'score': verif_scores.get((p, ent_idx), likelihood if likelihood is not None else 1.),
+                }
+        rejected = {entity_ids[address] for address, yes_probability in verif_scores.items() if yes_probability < verif_threshold}
+        predictions, candidates = [
+            [
+                {
+                    'doc_id': example['doc_id'],
+                    'text': example['text'],
+                    'entities': [],
+                }
+                for example in reference[chunk_start:chunk_end]
+            ]
+            for _ in range(2)
+        ]
+        for key, entity in entities.items():
+            candidates[key[0]]['entities'].append(entity)
+            if key not in rejected:
+                predictions[key[0]]['entities'].append(entity)
+        yield {
+            'start': chunk_start,
+            'predictions': predictions,
+            'candidates': candidates,
+            'references': reference[chunk_start:chunk_end],
+            'outputs': dict(zip(prompt_indices, outputs)),
+            'first_prompt_example': chunk_prompts[0],
+            'verif_prompt_example': verif_prompts[0] if len(verif_prompts)>0 else None,
+        }
+    if prefix_cache is not None:
+        logger.info(f"Prefix cache: {prefix_cache.hits} hits, {prefix_cache.misses} misses")
+    if generation_store is not None:
+        logger.info(f"Generation cache and log: {generation_store.stats()}")
+    if generation_log is not None:
+        generation_log.close()
+
+def predict_for_dataset(*args, on_chunk=None, collect=True, **kwargs):
+    # Collects the outputs of iter_predictions; on_chunk, if given, is called on every chunk as soon as it is done
+    # (e.g. to compute partial metrics). With collect=False, chunks are released once on_chunk has seen them,
+    # so that memory does not grow with the dataset, and the outputs and predictions returned are None.
+    outputs = {}
+    predictions = []
+    first_prompt_example = None
+    verif_prompt_example = None
+    for chunk in iter_predictions(*args, **kwargs):
+        if on_chunk is not None:
+            on_chunk(chunk)
+        if collect:
+            predictions.extend(chunk['predictions'])
+            outputs.update(chunk['outputs'])
+        first_prompt_example = first_prompt_example or chunk['first_prompt_example']
+        verif_prompt_example = verif_prompt_example or chunk['verif_prompt_example']
+    if not collect:
+        return None, None, first_prompt_example, verif_prompt_example
+    return [outputs[p] for p in sorted(outputs)], predictions, first_prompt_example, verif_prompt_example
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class GenerationStore:
+    # Persistent mapping from generation keys to generation results (anything JSON serializable).
+    # Subclasses implement get_many(keys), returning a dict of the keys found, and put_many(items).
+    @staticmethod
+    def key(model_name, settings, prompt):
+        return hashlib.sha256(json.dumps([model_name, settings, prompt]).encode()).hexdigest()
+
+    def cached(self, model_name, settings, prompts, generate, batch_size=None):
+        # Values for all prompts, calling generate(indices) only for the prompts that are not stored,
+        # once per distinct prompt (on its first index). generate must return the values of the given prompt indices, in order.
+        # With batch_size, generate is called on at most batch_size prompts at a time and its values are stored
+        # after each call, so that they are kept if a later call fails.
+        keys = [self.key(model_name, settings, prompt) for prompt in prompts]
+        found = self.get_many(keys)
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in found:
+                missing.setdefault(key, i)
+        missing_keys = list(missing)
+        batch_size = batch_size or max(len(missing_keys), 1)
+        for start in range(0, len(missing_keys), batch_size):
+            batch = missing_keys[start:start+batch_size]
+            new_values = dict(zip(batch, generate([missing[key] for key in batch])))
+            self.put_many(new_values)
+            found.update(new_values)
+        return [found[key] for key in keys]
+
+
+class GenerationCache(GenerationStore):
+    # On-disk cache of deterministic generation results, keyed by a hash of (model, generation settings, prompt).
+    # Values are anything JSON serializable. Entries are evicted least recently used first once the stored
+    # values exceed max_size bytes. Keeps hit/miss counters for the current process.
+    def __init__(self, path, max_size=2**30, query_size=500):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS generations_last_used ON generations (last_used)")
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM generations").fetchone()[0]
+        self.max_size = max_size
+        #sqlite limits the number of parameters of a query
+        self.query_size = query_size
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        found = {}
+        for start in range(0, len(keys), self.query_size):
+            batch = keys[start:start+self.query_size]
+            rows = self.connection.execute(f"SELECT key, value FROM generations WHERE key IN ({','.join('?'*len(batch))})", batch).fetchall()
+            found.update((key, json.loads(value)) for key, value in rows)
+        with self.connection:
+            self.connection.executemany("UPDATE generations SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found])
+        self.hits += len(found)
+        self.misses += len(set(keys))-len(found)
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        rows = [(key, json.dumps(value), now) for key, value in items.items()]
+        with self.connection:
+            for key, value, last_used in rows:
+                previous = self.connection.execute("SELECT size FROM generations WHERE key = ?", (key,)).fetchone()
+                self.total_size += len(value)-(previous[0] if previous else 0)
+                self.connection.execute("INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?)", (key, value, len(value), last_used))
+        self.evict()
+
+    def evict(self):
+        if self.total_size <= self.max_size:
+            return
+        to_delete = []
+        for key, size in self.connection.execute("SELECT key, size FROM generations ORDER BY last_used"):
+            if self.total_size <= self.max_size:
+                break
+            to_delete.append((key,))
+            self.total_size -= size
+        with self.connection:
+            self.connection.executemany("DELETE FROM generations WHERE key = ?", to_delete)
+
+    def stats(self):
+        total = self.hits+self.misses
+        return f"{self.hits} hits, {self.misses} misses ({self.hits/total if total else 0.:.1%} hit rate), {self.total_size} bytes stored"
+
+
+class GenerationLog(GenerationStore):
+    # Append-only log of the generations of a run, so that a run killed before its end can be resumed
+    # without generating again what was already done. Every process appends to new JSON lines shards
+    # of at most shard_size bytes, and reads all the shards in the directory when it starts. A line cut
+    # by a crash is ignored. Lines are flushed as they are written, and synced to disk shard by shard.
+    def __init__(self, directory, shard_size=2**26):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.entries = {}
+        shards = sorted(name for name in os.listdir(directory) if name.startswith("generations-") and name.endswith(".jsonl"))
+        for name in shards:
+            with open(os.path.join(directory, name)) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['key']] = entry['value']
+        self.next_shard = int(shards[-1][len("generations-"):-len(".jsonl")])+1 if shards else 0
+        self.shard = None
+        self.resumed = 0
+
+    def get_many(self, keys):
+        found = {key: self.entries[key] for key in keys if key in self.entries}
+        self.resumed += len(found)
+        return found
+
+    def put_many(self, items):
+        for key, value in items.items():
+            if self.shard is None or self.shard.tell() >= self.shard_size:
+                self.close()
+                self.shard = open(os.path.join(self.directory, f"generations-{self.next_shard:05d}.jsonl"), 'a')
+                self.next_shard += 1
+            self.shard.write(json.dumps({'key': key, 'value': value})+'\n')
+            self.entries[key] = value
+        if self.shard is not None:
+            self.shard.flush()
+
+    def close(self):
+        if self.shard is not None:
+            os.fsync(self.shard.fileno())
+            self.shard.close()
+            self.shard = None
+
+    def stats(self):
+        return f"{self.resumed} generations reused, {len(self.entries)} logged in {self.directory}"
+
+
+class ChainedStores(GenerationStore):
+    # Looks keys up in each store in turn, and copies what a store finds into the stores before it.
+    # New values are put in all stores.
+    def __init__(self, stores):
+        self.stores = stores
+
+    def get_many(self, keys):
+        found = {}
+        for k, store in enumerate(self.stores):
+            new_found = store.get_many([key for key in keys if key not in found])
+            for previous_store in self.stores[:k]:
+                previous_store.put_many(new_found)
+            found.update(new_found)
+        return found
+
+    def put_many(self, items):
+        for store in self.stores:
+            store.put_many(items)
+
+    def stats(self):
+        return "; ".join(store.stats() for store in self.stores)
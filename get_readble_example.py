@@ -1,6 +1,6 @@
 from nlstruct import HuggingfaceNERDataset, BRATDataset
 from dataset_info import get_dataset_colnames, get_dataset_tag_map
-from prompt_maker import make_prompts, example2string
+from prompt_maker import make_prompts, example2string, PromptEncoder
 from nlstruct.data_utils import sentencize
 
 #dataset_name = "/people/mnaguib/n2c2/"
@@ -33,7 +33,7 @@ for e in dataset.test_data:
 
 dataset.train_data = traindev_dataset
 dataset.test_data = test_dataset
-first_prompts_ner_tag, self_verif_template_ner_tag = make_prompts(
+first_prompts_ner_tag, prefix_ner_tag, self_verif_templates_ner_tag, fragments_ner_tag = make_prompts(
     dataset.train_data,
     #dataset.test_data[5:10],
     dataset.test_data[:100],
@@ -63,8 +63,8 @@ print(string)
 from transformers import AutoTokenizer
 t = AutoTokenizer.from_pretrained("mistralai/Mistral-7B-v0.1")
 #t = AutoTokenizer.from_pretrained("bigscience/bloom-7b1")
-lengths = []
-for prompt in first_prompts_ner_tag:
-    lengths.append(len(t.encode(prompt)))
+#lengths are counted from the token ids of the prompt fragments, each distinct fragment being tokenized once
+encoder = PromptEncoder(t)
+lengths = [encoder.length(fragments) for fragments in fragments_ner_tag]
 print(sum(lengths)/len(lengths))
-#print(self_verif_template_ner_tag)
+#print(self_verif_templates_ner_tag[0])
@@ -0,0 +1,261 @@
+import copy
+import math
+import inspect
+import functools
+import torch
+from tqdm import tqdm
+from collections import OrderedDict
+from transformers import StoppingCriteria, StoppingCriteriaList, GenerationConfig
+
+# Decoding loops of the transformers backend, which does not need vLLM.
+
+@functools.lru_cache(maxsize=None)
+def accepts_position_ids(model_class):
+    return 'position_ids' in inspect.signature(model_class.forward).parameters
+
+def forward_new_tokens(model, input_ids, attention_mask, past_key_values=None):
+    # Forward pass over the input ids that past_key_values (a transformers Cache, or None) does not hold yet.
+    # attention_mask covers the cached and new tokens, and positions are given explicitly so that padding
+    # (on the left, or between a shared prefix and the suffixes) is skipped. The model is called directly rather
+    # than through prepare_inputs_for_generation, whose cache handling changes between transformers versions.
+    # Returns the logits of the new tokens and the updated cache.
+    n_past = past_key_values.get_seq_length() if past_key_values is not None else 0
+    forward_kwargs = {}
+    if accepts_position_ids(type(model)):
+        forward_kwargs['position_ids'] = (attention_mask.long().cumsum(-1)-1).clamp(min=0)[:, n_past:]
+    output = model(input_ids[:, n_past:], attention_mask=attention_mask, past_key_values=past_key_values, use_cache=True, return_dict=True, **forward_kwargs)
+    return output.logits, output.past_key_values
+
+class Newline(StoppingCriteria):
+    def __init__(self, check_start, newline_token):
+        self.check_start = check_start
+        self.newline_token = newline_token
+        self.finished = None
+    
+    def __call__(self, input_ids: torch.LongTensor, score: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        #beam search reorders the sequences at every step, so the finished mask is recomputed from the whole continuations
+        self.finished = (input_ids[:, self.check_start:] == self.newline_token).any(dim=1)
+        #per sequence: generate() stops each sequence on its own when sampling, and beam search once all of them are done.
+        #Finished sequences still take part in the forward passes, only greedy_generate (num_beams 1) removes them
+        return self.finished
+
+
+class PrefixCache:
+    # Keeps the KV state of the most recently used prompt prefixes (instruction and shared demonstrations),
+    # so that only the sentence-specific suffix of each prompt has to be encoded.
+    def __init__(self, model, tokenizer, max_size=16):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @torch.no_grad()
+    def get(self, prefix):
+        if prefix in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(prefix)
+            return self.entries[prefix]
+        self.misses += 1
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(self.model.device)
+        _, past_key_values = forward_new_tokens(self.model, prefix_ids, torch.ones_like(prefix_ids))
+        self.entries[prefix] = (prefix_ids[0].tolist(), past_key_values)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return self.entries[prefix]
+
+    @torch.no_grad()
+    def encode_batch(self, prefix, prompts_ids, num_copies=1):
+        # Builds the inputs of a batch of tokenized prompts sharing a prefix: the prefix tokens, then the suffixes
+        # padded on their left, i.e. between prefix and suffix. Also returns the KV cache of every token but the last
+        # one (which the decoding loop feeds itself), with num_copies rows per prompt for beam search.
+        # Returns Nones if a prompt does not tokenize into the prefix tokens followed by a non-empty suffix.
+        prefix_ids, prefix_past = self.get(prefix)
+        n = len(prefix_ids)
+        if any(len(ids) <= n or ids[:n] != prefix_ids for ids in prompts_ids):
+            return None, None, None
+        suffix_length = max(len(ids) for ids in prompts_ids)-n
+        input_ids = torch.tensor([prefix_ids+[self.tokenizer.pad_token_id]*(suffix_length-len(ids)+n)+ids[n:] for ids in prompts_ids], device=self.model.device)
+        attention_mask = torch.tensor([[1]*n+[0]*(suffix_length-len(ids)+n)+[1]*(len(ids)-n) for ids in prompts_ids], device=self.model.device)
+        #forward passes extend the cache in place, the stored prefix state is tiled on a copy
+        past_key_values = copy.deepcopy(prefix_past)
+        past_key_values.batch_repeat_interleave(len(prompts_ids)*num_copies)
+        if suffix_length > 1:
+            _, past_key_values = forward_new_tokens(
+                self.model,
+                input_ids[:, :-1].repeat_interleave(num_copies, dim=0),
+                attention_mask[:, :-1].repeat_interleave(num_copies, dim=0),
+                past_key_values,
+            )
+        return input_ids, attention_mask, past_key_values
+
+
+@torch.no_grad()
+def greedy_generate(model, input_ids, attention_mask, past_key_values, newline_token, eos_token, max_new_tokens):
+    # Greedy decoding where each sequence finishes on its own at its first newline (or EOS).
+    # Finished sequences are removed from the batch and from the KV cache, so no step is spent on them.
+    # past_key_values, if given, covers every input token but the last one.
+    # Returns the generated ids of each sequence and the sum of their log probabilities.
+    rows = list(range(input_ids.shape[0]))
+    generated = [[] for _ in rows]
+    logprob_sums = [0.]*len(rows)
+    for _ in range(max_new_tokens):
+        logits, past_key_values = forward_new_tokens(model, input_ids, attention_mask, past_key_values)
+        logprobs = logits[:, -1, :].float().log_softmax(-1)
+        next_tokens = logprobs.argmax(-1)
+        next_logprobs = logprobs.gather(1, next_tokens.unsqueeze(1)).squeeze(1)
+        keep = []
+        for k, (token, logprob) in enumerate(zip(next_tokens.tolist(), next_logprobs.tolist())):
+            generated[rows[k]].append(token)
+            logprob_sums[rows[k]] += logprob
+            if token not in [newline_token, eos_token]:
+                keep.append(k)
+        if not keep:
+            break
+        if len(keep) < len(rows):
+            index = torch.tensor(keep, device=input_ids.device)
+            past_key_values.batch_select_indices(index)
+            input_ids, attention_mask, next_tokens = input_ids[index], attention_mask[index], next_tokens[index]
+            rows = [rows[k] for k in keep]
+        input_ids = torch.cat([input_ids, next_tokens.unsqueeze(1)], dim=1)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(rows), 1))], dim=1)
+    return generated, logprob_sums
+
+def make_batches(lengths, keys, max_batch_tokens, max_new_tokens, num_beams=1):
+    # Groups prompts sharing the same key (e.g. their prefix) into batches of similar token lengths,
+    # each as large as fits in max_batch_tokens, counting the padded length of every beam.
+    order = sorted(range(len(lengths)), key=lambda i: (keys[i], lengths[i]))
+    batches = []
+    for i in order:
+        if batches and keys[batches[-1][0]] == keys[i] and (len(batches[-1])+1)*num_beams*(lengths[i]+max_new_tokens) <= max_batch_tokens:
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
+
+def encode_batch_inputs(tokenizer, prefix_cache, prompts_ids, prefix=None, num_copies=1):
+    # Model inputs of a batch of tokenized prompts, reusing the KV state of their shared prefix when possible,
+    # else left padded without any cache.
+    if prefix is not None:
+        input_ids, attention_mask, past_key_values = prefix_cache.encode_batch(prefix, prompts_ids, num_copies=num_copies)
+        if input_ids is not None:
+            return input_ids, attention_mask, past_key_values
+    input_tokens = tokenizer.pad({'input_ids': prompts_ids}, return_tensors="pt")
+    return input_tokens.input_ids.to(prefix_cache.model.device), input_tokens.attention_mask.to(prefix_cache.model.device), None
+
+@torch.no_grad()
+def hf_answer_probabilities(model, tokenizer, prompts, prefixes, prefix_cache, answer_tokens, max_batch_tokens=32768):
+    # Scores each prompt with a single forward pass: the probability of the first of answer_tokens
+    # once the next token is restricted to answer_tokens.
+    prompts_ids = tokenizer(prompts).input_ids
+    keys = prefixes if prefixes is not None else [""]*len(prompts)
+    probabilities = [None]*len(prompts)
+    for batch in tqdm(make_batches([len(ids) for ids in prompts_ids], keys, max_batch_tokens, 1)):
+        input_ids, attention_mask, past_key_values = encode_batch_inputs(tokenizer, prefix_cache, [prompts_ids[i] for i in batch], prefixes[batch[0]] if prefixes is not None else None)
+        logits, _ = forward_new_tokens(model, input_ids, attention_mask, past_key_values)
+        logits = logits[:, -1, answer_tokens]
+        for i, probability in zip(batch, logits.float().softmax(-1)[:, 0].tolist()):
+            probabilities[i] = probability
+    return probabilities
+
+@torch.no_grad()
+def hf_generate(model, tokenizer, prompts, prefixes, prefix_cache, model_kwargs, newline_token, max_new_tokens=128, max_batch_tokens=32768, prompts_ids=None):
+    # Generates the first line of the continuation of each prompt by length-bucketed batches,
+    # with greedy_generate when decoding is greedy (num_beams 1), which drops finished sequences from the batch,
+    # and model.generate otherwise, which keeps computing them until the whole batch is done.
+    # Prompts with the same prefix are batched together, so that the prefix KV state is computed once.
+    # Also returns the likelihood of each output (geometric mean of its token probabilities),
+    # or None when sampling, as model.generate then does not score the sequences.
+    # prompts_ids, if given, are the token ids of the prompts, which are then not tokenized again.
+    generation_config = GenerationConfig.from_dict(model_kwargs)
+    if prompts_ids is None:
+        prompts_ids = tokenizer(prompts).input_ids
+    keys = prefixes if prefixes is not None else [""]*len(prompts)
+    outputs = [None]*len(prompts)
+    likelihoods = [None]*len(prompts)
+    for batch in tqdm(make_batches([len(ids) for ids in prompts_ids], keys, max_batch_tokens, max_new_tokens, generation_config.num_beams)):
+        input_ids, attention_mask, past_key_values = encode_batch_inputs(tokenizer, prefix_cache, [prompts_ids[i] for i in batch], prefixes[batch[0]] if prefixes is not None else None, num_copies=generation_config.num_beams)
+        if generation_config.num_beams == 1 and not generation_config.do_sample:
+            generated, logprob_sums = greedy_generate(model, input_ids, attention_mask, past_key_values, newline_token, tokenizer.eos_token_id, max_new_tokens)
+            for i, ids, logprob_sum in zip(batch, generated, logprob_sums):
+                likelihoods[i] = math.exp(logprob_sum/len(ids))
+        else:
+            stopping_criteria = StoppingCriteriaList([Newline(check_start=input_ids.shape[1], newline_token=newline_token)])
+            output_batch = model.generate(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values, stopping_criteria=stopping_criteria, max_new_tokens=max_new_tokens, pad_token_id=tokenizer.pad_token_id, generation_config=generation_config, output_scores=True, return_dict_in_generate=True)
+            generated = output_batch.sequences[:, input_ids.shape[1]:]
+            #beam scores are already normalized by the sequence length
+            if getattr(output_batch, 'sequences_scores', None) is not None:
+                for i, score in zip(batch, output_batch.sequences_scores.tolist()):
+                    likelihoods[i] = math.exp(score)
+        #with beam search, sequences that stopped early keep going until the whole batch is done, only their first line is kept
+        for i, output in zip(batch, tokenizer.batch_decode(generated, skip_special_tokens=True)):
+            outputs[i] = output.split('\n')[0]
+    return outputs, likelihoods
+
+@torch.no_grad()
+def constrained_generate(model, tokenizer, prompts, entries, newline_token, eos_token, begin_tag_toks, end_tag_toks, sticked, batch_size=8, max_new_tokens=512):
+    # Copies each entry token by token, only letting the model choose between the next entry token,
+    # opening a tag, closing a tag (if one is open) or stopping. Sentences are decoded in batches with
+    # a persistent KV cache, so each step is a single forward pass over one new token per sentence.
+    outputs = [None]*len(prompts)
+    #sort by length so that batches need as little padding as possible
+    order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+    for b in tqdm(range(0, len(order), batch_size)):
+        batch_indices = order[b:b+batch_size]
+        encoded = tokenizer([prompts[i] for i in batch_indices], padding=True, return_tensors="pt")
+        input_ids = encoded.input_ids.to(model.device)
+        attention_mask = encoded.attention_mask.to(model.device)
+        states = [
+            {
+                'entry': list(entries[i]),
+                'nb_open_entities': 0,
+                'generated': [],
+                'forced': [],
+                'num_new_tokens': 0,
+                'done': len(entries[i])<=1 or input_ids[row, -1].item() in [newline_token, eos_token],
+            }
+            for row, i in enumerate(batch_indices)
+        ]
+        past_key_values = None
+        while not all(state['done'] for state in states):
+            logits, past_key_values = forward_new_tokens(model, input_ids, attention_mask, past_key_values)
+            next_logits = logits[:, -1, :]
+            next_tokens = []
+            next_mask = []
+            for row, state in enumerate(states):
+                if state['done']:
+                    next_tokens.append(tokenizer.pad_token_id)
+                    next_mask.append(0)
+                    continue
+                if not state['forced']:
+                    next_entry_id = state['entry'][0]
+                    if state['nb_open_entities']<=0:
+                        allowed_tokens = [next_entry_id, begin_tag_toks[0], eos_token]
+                    else:
+                        allowed_tokens = [next_entry_id, begin_tag_toks[0], end_tag_toks[0]]
+                    generated_id = allowed_tokens[next_logits[row, allowed_tokens].argmax().item()]
+                    if generated_id in [next_entry_id, eos_token]:
+                        state['entry'] = state['entry'][1:]
+                        state['forced'] = [generated_id]
+                    elif generated_id==begin_tag_toks[0]:
+                        state['nb_open_entities']+=1
+                        state['forced'] = list(begin_tag_toks)
+                        if sticked:
+                            state['entry'] = tokenizer.encode("@"+tokenizer.decode(state['entry']), add_special_tokens=False)[1:]
+                    else:
+                        state['nb_open_entities']-=1
+                        state['forced'] = list(end_tag_toks)
+                    state['num_new_tokens']+=len(state['forced'])
+                #multi-token tags are fed one token per step, without consulting the model
+                token = state['forced'].pop(0)
+                state['generated'].append(token)
+                next_tokens.append(token)
+                next_mask.append(1)
+                if not state['forced']:
+                    state['done'] = token in [newline_token, eos_token] or len(state['entry'])<=1 or state['num_new_tokens']>=max_new_tokens
+            input_ids = torch.cat([input_ids, torch.tensor(next_tokens, device=input_ids.device).unsqueeze(1)], dim=1)
+            attention_mask = torch.cat([attention_mask, torch.tensor(next_mask, device=attention_mask.device).unsqueeze(1)], dim=1)
+        for row, i in enumerate(batch_indices):
+            outputs[i] = tokenizer.decode(states[row]['generated'], skip_special_tokens=True).strip()
+    return outputs
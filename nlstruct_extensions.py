@@ -1,3 +1,7 @@
+import hashlib
+import multiprocessing
+import warnings
+import numpy as np
 import torch
 from torchmetrics import Metric
 
@@ -8,6 +12,7 @@ from datasets import load_dataset, load_from_disk
 from nlstruct.data_utils import regex_tokenize, split_spans, dedup
 from nlstruct.torch_utils import pad_to_tensor
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 def entity_match_filter(labels, matcher):
     labels = labels if isinstance(labels, (tuple, list)) else (labels,)
@@ -18,6 +23,40 @@ def entity_match_filter(labels, matcher):
     return eval(matcher, None, eval_locals)
 
 
+class WordOffsetsCache:
+    # Word offsets of document texts, keyed by a hash of the text, so that the reference documents evaluated again
+    # and again (once per hyperparameter configuration) are only tokenized once.
+    def __init__(self, word_regex):
+        self.word_regex = word_regex
+        self.offsets = {}
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode()).digest()
+
+    def add(self, docs):
+        for doc in docs:
+            self(doc["text"])
+
+    def __call__(self, text):
+        key = self.key(text)
+        if key not in self.offsets:
+            words = regex_tokenize(text, reg=self.word_regex, do_unidecode=True, return_offsets_mapping=True)
+            self.offsets[key] = {"begin": np.asarray(words["begin"]), "end": np.asarray(words["end"])}
+        return self.offsets[key]
+
+
+# metric of the worker processes of a parallel update, set when they start
+_worker_metric = None
+
+def _init_worker(metric):
+    global _worker_metric
+    _worker_metric = metric
+
+def _count_shard(preds, targets):
+    return _worker_metric.count(preds, targets)
+
+
 class DocumentEntityMetricPerLabel(Metric):
     def __init__(
           self,
@@ -35,6 +74,10 @@ class DocumentEntityMetricPerLabel(Metric):
           dist_sync_fn=None,
           explode_fragments=False,
           prefix="",
+          device="cpu",
+          fast_matching=True,
+          word_cache=None,
+          n_workers=1,
     ):
         # `compute_on_step` was removed from torchmetrics v0.9
         # keep the argument in signature for compatibility
@@ -51,20 +94,82 @@ class DocumentEntityMetricPerLabel(Metric):
         self.eval_fragments_label = eval_fragments_label
         self.explode_fragments = explode_fragments
         self.word_regex = word_regex
+        # not a state: the word offsets are kept across resets
+        self.word_cache = word_cache if word_cache is not None else WordOffsetsCache(word_regex)
+        assert self.word_cache.word_regex == word_regex, "the word cache was built with another word regex"
         self.add_label_specific_metrics = add_label_specific_metrics
+        # with n_workers > 1, updates split the documents in contiguous shards counted by a pool of processes,
+        # forked by start_workers, which must thus be called before any model is loaded
+        self.n_workers = n_workers
+        self.pool = None
         self.binarize_label_threshold = float(binarize_label_threshold) if binarize_label_threshold is not False else binarize_label_threshold
-        self.binarize_tag_threshold = float(binarize_tag_threshold) if binarize_tag_threshold is not False else binarize_tag_threshold
-        self.add_state("true_positive", default=torch.tensor(0., device="cuda"), dist_reduce_fx="sum")
-        self.add_state("pred_count", default=torch.tensor(0., device="cuda"), dist_reduce_fx="sum")
-        self.add_state("gold_count", default=torch.tensor(0., device="cuda"), dist_reduce_fx="sum")
-        for label in self.add_label_specific_metrics:
-           self.add_state(f"{label}_true_positive", default=torch.tensor(0., device="cuda"), dist_reduce_fx="sum")
-           self.add_state(f"{label}_pred_count", default=torch.tensor(0., device="cuda"), dist_reduce_fx="sum")
-           self.add_state(f"{label}_gold_count", default=torch.tensor(0., device="cuda"), dist_reduce_fx="sum")
+        # binarize_tag_threshold may be a dict of named thresholds, the entities of each document are then tokenized and
+        # scored once for all of them, and compute() returns the results of each threshold by name
+        self.multi_threshold = isinstance(binarize_tag_threshold, dict)
+        tag_thresholds = binarize_tag_threshold if self.multi_threshold else {"": binarize_tag_threshold}
+        self.tag_thresholds = {name: float(threshold) if threshold is not False else threshold for name, threshold in tag_thresholds.items()}
+        if not self.multi_threshold:
+            self.binarize_tag_threshold = self.tag_thresholds[""]
+        # documents whose entities all have a single fragment and a single label are matched corpus-wide with numpy
+        self.fast_matching = (
+              fast_matching and not joint_matching and not explode_fragments and not eval_fragments_label
+              and self.binarize_label_threshold is not False
+              and all(threshold is not False and 0. < threshold <= 1. for threshold in self.tag_thresholds.values())
+        )
+        # counts are accumulated as python numbers over each update, and only added to the states (on any device) at its end
+        for name in self.tag_thresholds:
+            self.add_state(self.state_name(name, "true_positive"), default=torch.tensor(0., device=device), dist_reduce_fx="sum")
+            self.add_state(self.state_name(name, "pred_count"), default=torch.tensor(0., device=device), dist_reduce_fx="sum")
+            self.add_state(self.state_name(name, "gold_count"), default=torch.tensor(0., device=device), dist_reduce_fx="sum")
+            for label in self.add_label_specific_metrics:
+               self.add_state(self.state_name(name, f"{label}_true_positive"), default=torch.tensor(0., device=device), dist_reduce_fx="sum")
+               self.add_state(self.state_name(name, f"{label}_pred_count"), default=torch.tensor(0., device=device), dist_reduce_fx="sum")
+               self.add_state(self.state_name(name, f"{label}_gold_count"), default=torch.tensor(0., device=device), dist_reduce_fx="sum")
+
+    @staticmethod
+    def state_name(threshold_name, counter):
+        return f"{threshold_name}_{counter}" if threshold_name else counter
+
+    def cache_words(self, docs):
+        """Tokenizes the reference documents ahead of the evaluations that will use them."""
+        # workers only see the word cache as it was when they were forked, call this before start_workers
+        self.word_cache.add(docs)
+
+    def start_workers(self):
+        """
+        Starts the worker processes, if n_workers > 1 and they are not running yet. They are forked, so that they
+        inherit this metric and its word cache without pickling it, and so that scripts without a __main__ guard
+        (like the experiment scripts) are not run again. Forking a process where CUDA or other threads already run
+        can make workers hang or crash, so this has to happen before the model is loaded.
+        Only metrics whose thresholds binarize the match scores count in parallel: their counts are then integers,
+        summed exactly whatever the sharding. Fractional scores would make the results depend on n_workers.
+        """
+        if self.pool is not None or self.n_workers <= 1:
+            return
+        if self.binarize_label_threshold is False or any(threshold is False for threshold in self.tag_thresholds.values()):
+            warnings.warn("Match scores are not binarized, metric updates stay serial")
+            return
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            warnings.warn("Forking metric workers after CUDA was initialized, they may hang or crash")
+        self.pool = ProcessPoolExecutor(self.n_workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_worker, initargs=(self,))
+        # the executor only forks its processes when a first task is submitted
+        list(self.pool.map(int, range(self.n_workers)))
+
+    def close(self):
+        """Shuts the worker processes down, later updates are serial until start_workers is called again."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
 
     def increment(self, name, by=1):
         """Increments a counter specified by the 'name' argument."""
         self.__dict__[name] += by
+
+    def __getstate__(self):
+        return {k: v for k, v in super().__getstate__().items() if k != "pool"}
+
+    def __setstate__(self, state):
+        super().__setstate__({**state, "pool": None})
    
     def update(self, preds, targets):
         """
@@ -74,15 +179,129 @@ class DocumentEntityMetricPerLabel(Metric):
             preds: Predictions from model
             target: Ground truth values
         """
+        preds, targets = list(preds), list(targets)
+        if self.pool is not None and len(preds) > 1:
+            shard_size = -(-len(preds) // self.n_workers)
+            starts = range(0, len(preds), shard_size)
+            counts = defaultdict(float)
+            # workers only run with binarized scores (see start_workers), the counts are sums of integers
+            # and the reduction is exact in any order
+            for shard_counts in self.pool.map(_count_shard, [preds[start:start+shard_size] for start in starts], [targets[start:start+shard_size] for start in starts]):
+                for name, count in shard_counts.items():
+                    counts[name] += count
+        else:
+            counts = self.count(preds, targets)
+        for name, count in counts.items():
+            self.increment(name, by=count)
+
+    def count(self, preds, targets):
+        """Counts of the (pred_doc, gold_doc) pairs, by state name."""
+        counts = defaultdict(float)
+        def add_counts(label_counts):
+            # label_counts maps each label to (true positives by threshold name, pred count, gold count)
+            for label,(tps, pc, gc) in label_counts.items():
+                for name, tp in tps.items():
+                    counts[self.state_name(name, f"true_positive")] += tp
+                    counts[self.state_name(name, f"pred_count")] += pc
+                    counts[self.state_name(name, f"gold_count")] += gc
+                    if label in self.add_label_specific_metrics:
+                        counts[self.state_name(name, f"{label}_true_positive")] += tp
+                        counts[self.state_name(name, f"{label}_pred_count")] += pc
+                        counts[self.state_name(name, f"{label}_gold_count")] += gc
+        single_fragment_docs = []
         for pred_doc, gold_doc in zip(preds, targets):
-            for label,(tp, pc, gc) in self.compare_two_samples(pred_doc, gold_doc).items():
-                self.increment(f"true_positive", by=tp)
-                self.increment(f"pred_count", by=pc)
-                self.increment(f"gold_count", by=gc)
-                if label in self.add_label_specific_metrics:
-                    self.increment(f"{label}_true_positive", by=tp)
-                    self.increment(f"{label}_pred_count", by=pc)
-                    self.increment(f"{label}_gold_count", by=gc)
+            if self.fast_matching and self.is_single_fragment(pred_doc) and self.is_single_fragment(gold_doc):
+                single_fragment_docs.append((pred_doc, gold_doc))
+            else:
+                add_counts(self.compare_two_samples(pred_doc, gold_doc))
+        add_counts(self.compare_single_fragment_samples(single_fragment_docs))
+        return dict(counts)
+
+    def filtered_entities(self, doc):
+        return [entity for entity in doc["entities"]
+                if self.filter_entities is None
+                or entity_match_filter(entity["label"], self.filter_entities)]
+
+    def is_single_fragment(self, doc):
+        return all(len(entity["fragments"]) == 1 and isinstance(entity["label"], str) and "complete_labels" not in entity
+                   for entity in self.filtered_entities(doc))
+
+    def compare_single_fragment_samples(self, docs):
+        """
+        Same counts as compare_two_samples summed over (pred_doc, gold_doc) pairs whose entities all have a single
+        fragment and a single label. Each entity is then a (begin, end) word interval, and its tag match score with
+        another one is their dice overlap. Candidate pairs (same document and label, overlapping) are found and scored
+        for the whole corpus at once, and each prediction takes its best gold match. Only the documents where the same
+        gold entity is the best match of several predictions are matched greedily, as compare_two_samples does.
+        """
+        labels = {}
+        pred_rows, gold_rows = [], []  # (document, label, begin word, end word)
+        for doc_idx, (pred_doc, gold_doc) in enumerate(docs):
+            assert pred_doc["text"] == gold_doc["text"], f'Mismatch:\n{pred_doc["text"]}\nvs.\n{gold_doc["text"]}'
+            pred_doc_entities = self.filtered_entities(pred_doc)
+            gold_doc_entities = self.filtered_entities(gold_doc)
+            if not pred_doc_entities and not gold_doc_entities:
+                continue
+            words = self.word_cache(gold_doc["text"])
+            entities = pred_doc_entities + gold_doc_entities
+            begins, ends = split_spans([entity["fragments"][0]["begin"] for entity in entities], [entity["fragments"][0]["end"] for entity in entities], words["begin"], words["end"])
+            for entity_idx, (entity, begin, end) in enumerate(zip(entities, begins, ends)):
+                row = (doc_idx, labels.setdefault(entity["label"], len(labels)), begin, end)
+                (pred_rows if entity_idx < len(pred_doc_entities) else gold_rows).append(row)
+        pred_rows = np.array(pred_rows, dtype=np.int64).reshape(-1, 4)
+        gold_rows = np.array(gold_rows, dtype=np.int64).reshape(-1, 4)
+        pred_count = np.bincount(pred_rows[:, 1], minlength=len(labels))
+        gold_count = np.bincount(gold_rows[:, 1], minlength=len(labels))
+
+        # every (pred, gold) pair of the same document and label, gold entities being sorted by (document, label, index)
+        pred_keys = pred_rows[:, 0] * len(labels) + pred_rows[:, 1]
+        gold_keys = gold_rows[:, 0] * len(labels) + gold_rows[:, 1]
+        gold_order = np.argsort(gold_keys, kind="stable")
+        group_begin = np.searchsorted(gold_keys[gold_order], pred_keys, side="left")
+        group_size = np.searchsorted(gold_keys[gold_order], pred_keys, side="right") - group_begin
+        pair_pred = np.repeat(np.arange(len(pred_rows)), group_size)
+        pair_offset = np.arange(group_size.sum()) - np.repeat(np.cumsum(group_size) - group_size, group_size)
+        pair_gold = gold_order[np.repeat(group_begin, group_size) + pair_offset]
+
+        # tag match scores, in float32 as in compare_two_samples
+        pred_begin, pred_end = pred_rows[pair_pred, 2], pred_rows[pair_pred, 3]
+        gold_begin, gold_end = gold_rows[pair_gold, 2], gold_rows[pair_gold, 3]
+        overlap = np.clip(np.minimum(pred_end, gold_end) - np.maximum(pred_begin, gold_begin), 0, None)
+        scores = (2 * overlap).astype(np.float32) / np.maximum((pred_end - pred_begin) + (gold_end - gold_begin), 1).astype(np.float32)
+        candidates = overlap > 0
+        pair_pred, pair_gold, scores = pair_pred[candidates], pair_gold[candidates], scores[candidates]
+
+        # best gold match of each prediction (the first one among equal scores)
+        order = np.lexsort((pair_gold, -scores, pair_pred))
+        pair_pred, pair_gold, scores = pair_pred[order], pair_gold[order], scores[order]
+        first = np.ones(len(pair_pred), dtype=bool)
+        first[1:] = pair_pred[1:] != pair_pred[:-1]
+        best_pred, best_gold, best_score = pair_pred[first], pair_gold[first], scores[first]
+
+        true_positive = {}
+        for name, threshold in self.tag_thresholds.items():
+            true_positive[name] = np.zeros(len(labels))
+            matched = best_score >= np.float32(threshold)
+            # documents where a gold entity is matched by several predictions need the greedy matching
+            matched_gold, gold_matches = np.unique(best_gold[matched], return_counts=True)
+            greedy_docs = np.unique(gold_rows[matched_gold[gold_matches > 1], 0])
+            direct = matched & ~np.isin(pred_rows[best_pred, 0], greedy_docs)
+            np.add.at(true_positive[name], pred_rows[best_pred[direct], 1], 1.)
+
+            in_greedy_docs = np.isin(pred_rows[pair_pred, 0], greedy_docs)
+            removed = set()
+            previous_pred = -1
+            for pred_idx, gold_idx, score in zip(pair_pred[in_greedy_docs].tolist(), pair_gold[in_greedy_docs].tolist(), scores[in_greedy_docs].tolist()):
+                # pairs come by prediction, best match first: each prediction takes its first available gold entity
+                if pred_idx == previous_pred or gold_idx in removed:
+                    continue
+                previous_pred = pred_idx
+                if score >= np.float32(threshold):
+                    true_positive[name][pred_rows[pred_idx, 1]] += 1.
+                    removed.add(gold_idx)
+
+        return {label: ({name: float(tp[label_idx]) for name, tp in true_positive.items()}, int(pred_count[label_idx]), int(gold_count[label_idx]))
+                for label, label_idx in labels.items()}
 
     def compare_two_samples(self, pred_doc, gold_doc, return_match_scores=False):
         assert pred_doc["text"] == gold_doc["text"], f'Mismatch:\n{pred_doc["text"]}\nvs.\n{gold_doc["text"]}'
@@ -101,7 +320,7 @@ class DocumentEntityMetricPerLabel(Metric):
             gold_doc_entities = [{"label": f.get("label", "main"), "fragments": [f]} for f in
                                  dedup((f for entity in gold_doc_entities for f in entity["fragments"]), key=lambda x: (x['begin'], x['end'], x.get('label', None)))]
 
-        words = regex_tokenize(gold_doc["text"], reg=self.word_regex, do_unidecode=True, return_offsets_mapping=True)
+        words = self.word_cache(gold_doc["text"])
 
         all_fragment_labels = set()
         all_entity_labels = set()
@@ -196,62 +415,63 @@ class DocumentEntityMetricPerLabel(Metric):
         label_match_precision = torch.einsum("pk,gk->pg", pred_entities_labels.float(), gold_entities_optional_labels.float()) / pred_entities_labels.float().sum(-1).unsqueeze(1).clamp_min(1.)
         label_match_recall = torch.einsum("pk,gk->pg", pred_entities_labels.float(), gold_entities_labels.float()) / gold_entities_labels.float().sum(-1).unsqueeze(0).clamp_min(1.)
         label_match_scores = 2 / (1. / label_match_precision + 1. / label_match_recall)
-        match_scores = label_match_scores * tag_match_scores
-        if self.binarize_tag_threshold is not False:
-            tag_match_scores = (tag_match_scores >= self.binarize_tag_threshold).float()
-        if self.binarize_label_threshold is not False:
-            label_match_scores = (label_match_scores >= self.binarize_tag_threshold).float()
-        effective_scores = tag_match_scores * label_match_scores
+        unmatched_scores = label_match_scores * tag_match_scores
         
         results={}
         
         pred_values = [p['label'] for p in pred_doc_entities]
         gold_values = [g['label'] for g in gold_doc_entities]
         
-        score_per_label = {l:0. for l in all_entity_labels}
-        matched_scores = torch.zeros_like(match_scores) - 1.
-        for pred_idx in range(match_scores.shape[0]):
-            if self.joint_matching:
-                pred_idx = match_scores.max(-1).values.argmax()
-            gold_idx = match_scores[pred_idx].argmax()
-            if not any(gold_entities_labels[gold_idx]):
-                continue
-            ent_label = all_entity_labels[gold_entities_labels[gold_idx].nonzero().squeeze()]
-            match_score = match_scores[pred_idx, gold_idx].float()
-            effective_score = effective_scores[pred_idx, gold_idx].float()
-            matched_scores[pred_idx, gold_idx] = max(matched_scores[pred_idx, gold_idx], effective_score)
-            if match_score >= 0 and effective_score > 0:
-                score_per_label[ent_label] += effective_score
-                match_scores[:, gold_idx] = -1
-                match_scores[pred_idx, :] = -1
-        on_cuda = True
-        # return {l : (float(score_per_label[l]), pred_values.count(l), gold_values.count(l))
-        #             for l in all_entity_labels}
-        if on_cuda :
-            #make sure to return a tuple of tensors
-            return {l : (torch.tensor(score_per_label[l]).cuda(), torch.tensor(pred_values.count(l)).cuda(), torch.tensor(gold_values.count(l)).cuda())
-                        for l in all_entity_labels}
-        else :
-            return {l : (torch.tensor(score_per_label[l]), torch.tensor(pred_values.count(l)), torch.tensor(gold_values.count(l)))
-                        for l in all_entity_labels}
+        # the scores are computed once, and the matching is made for each threshold
+        score_per_label = {l:{} for l in all_entity_labels}
+        for name, threshold in self.tag_thresholds.items():
+            match_scores = unmatched_scores.clone()
+            binarized_tag_match_scores = (tag_match_scores >= threshold).float() if threshold is not False else tag_match_scores
+            binarized_label_match_scores = (label_match_scores >= threshold).float() if self.binarize_label_threshold is not False else label_match_scores
+            effective_scores = binarized_tag_match_scores * binarized_label_match_scores
+            for l in all_entity_labels:
+                score_per_label[l][name] = 0.
+            matched_scores = torch.zeros_like(match_scores) - 1.
+            for pred_idx in range(match_scores.shape[0]):
+                if self.joint_matching:
+                    pred_idx = match_scores.max(-1).values.argmax()
+                gold_idx = match_scores[pred_idx].argmax()
+                if not any(gold_entities_labels[gold_idx]):
+                    continue
+                ent_label = all_entity_labels[gold_entities_labels[gold_idx].nonzero().squeeze()]
+                match_score = match_scores[pred_idx, gold_idx].float()
+                effective_score = effective_scores[pred_idx, gold_idx].float()
+                matched_scores[pred_idx, gold_idx] = max(matched_scores[pred_idx, gold_idx], effective_score)
+                if match_score >= 0 and effective_score > 0:
+                    score_per_label[ent_label][name] += float(effective_score)
+                    match_scores[:, gold_idx] = -1
+                    match_scores[pred_idx, :] = -1
+        return {l : (score_per_label[l], pred_values.count(l), gold_values.count(l))
+                    for l in all_entity_labels}
 
     def compute(self):
         """
         Computes accuracy over state.
         """
+        if self.multi_threshold:
+            return {name: self.compute_threshold(name) for name in self.tag_thresholds}
+        return self.compute_threshold("")
+
+    def compute_threshold(self, name):
+        true_positive, pred_count, gold_count = getattr(self, self.state_name(name, "true_positive")), getattr(self, self.state_name(name, "pred_count")), getattr(self, self.state_name(name, "gold_count"))
         results={}
-        if self.gold_count == 0 and self.pred_count == 0:
+        if gold_count == 0 and pred_count == 0:
            results[self.prefix + f"tp"]= 0
            results[self.prefix + f"precision"]= 1
            results[self.prefix + f"_recall"]= 1
            results[self.prefix + f"f1"]= 1
         else :
-           results[self.prefix + "tp"] = self.true_positive
-           results[self.prefix + "precision"]= self.true_positive / max(1, self.pred_count)
-           results[self.prefix + "recall"]= self.true_positive/ max(1, self.gold_count)
-           results[self.prefix + "f1"]= (self.true_positive * 2) / (self.pred_count + self.gold_count)
+           results[self.prefix + "tp"] = true_positive
+           results[self.prefix + "precision"]= true_positive / max(1, pred_count)
+           results[self.prefix + "recall"]= true_positive/ max(1, gold_count)
+           results[self.prefix + "f1"]= (true_positive * 2) / (pred_count + gold_count)
         for label in self.add_label_specific_metrics:
-            l_true_positive, l_gold_count, l_pred_count = getattr(self, f"{label}_true_positive"), getattr(self, f"{label}_gold_count"), getattr(self, f"{label}_pred_count")
+            l_true_positive, l_gold_count, l_pred_count = getattr(self, self.state_name(name, f"{label}_true_positive")), getattr(self, self.state_name(name, f"{label}_gold_count")), getattr(self, self.state_name(name, f"{label}_pred_count"))
             if l_gold_count == 0 and l_pred_count == 0:
                results[self.prefix + f"{label}_tp"]= 0
                results[self.prefix + f"{label}_precision"]= 1
@@ -1,3 +1,5 @@
+import numpy as np
+
 def full_preds_string(textual_outputs, predicted_dataset, reference_dataset, ner_tags):
     full_preds = ""
     for i, (o, pred, gold) in enumerate(zip(textual_outputs, predicted_dataset, reference_dataset)):
@@ -17,4 +19,50 @@ def get_metrics_string(metrics_dict, ner_tags):
         s_metrics+=f'ALL    tp: {metric["tp"]}    precision: {metric["precision"]}    recall: {metric["recall"]}    f1: {metric["f1"]}\n'
         for tag in ner_tags:
             s_metrics+=f'{tag}    tp: {metric[tag+"_tp"]}    precision: {metric[tag+"_precision"]}    recall: {metric[tag+"_recall"]}    f1: {metric[tag+"_f1"]}\n'
-    return s_metrics
\ No newline at end of file
+    return s_metrics
+
+class ThresholdSweep:
+    # Accumulates candidates chunk by chunk for threshold_sweep, keeping only the score and correctness of each one.
+    def __init__(self, ner_tags):
+        self.ner_tags = ner_tags
+        self.scores = []
+        self.correct = []
+        self.n_gold = 0
+
+    def update(self, candidate_dataset, reference_dataset):
+        # a candidate is correct if a gold entity of the same document has its label and exact fragments
+        for pred, gold in zip(candidate_dataset, reference_dataset):
+            gold_keys = {(g['label'], tuple((f['begin'], f['end']) for f in g['fragments'])) for g in gold['entities'] if g['label'] in self.ner_tags}
+            self.n_gold += len(gold_keys)
+            pred_keys = {}
+            for p in pred['entities']:
+                key = (p['label'], tuple((f['begin'], f['end']) for f in p['fragments']))
+                #the same span predicted twice counts once, with its best score
+                pred_keys[key] = max(pred_keys.get(key, 0.), p.get('score', 1.))
+            for key, score in pred_keys.items():
+                self.scores.append(score)
+                self.correct.append(key in gold_keys)
+
+    def compute(self, thresholds):
+        scores, correct, thresholds = np.array(self.scores, dtype=float), np.array(self.correct, dtype=bool), np.asarray(thresholds, dtype=float)
+        kept = scores[None, :] >= thresholds[:, None]
+        tp = (kept & correct[None, :]).sum(1)
+        n_pred = kept.sum(1)
+        precision = tp/np.maximum(n_pred, 1)
+        recall = tp/max(self.n_gold, 1)
+        f1 = 2*precision*recall/np.maximum(precision+recall, 1e-12)
+        return {
+            'thresholds': thresholds.tolist(),
+            'tp': tp.tolist(),
+            'precision': precision.round(3).tolist(),
+            'recall': recall.round(3).tolist(),
+            'f1': f1.round(3).tolist(),
+        }
+
+def threshold_sweep(candidate_dataset, reference_dataset, ner_tags, thresholds):
+    # Precision, recall and f1 of the candidates scoring at least each threshold, from a single matching of
+    # every candidate: a candidate is correct if a gold entity of the same document has its label and exact fragments.
+    # All thresholds are then evaluated at once, so that precision/recall curves do not need to rerun the model.
+    sweep = ThresholdSweep(ner_tags)
+    sweep.update(candidate_dataset, reference_dataset)
+    return sweep.compute(thresholds)
@@ -1,23 +1,39 @@
 import random
 import re
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import functools
+from collections import defaultdict, OrderedDict
+from retrievers import get_retriever
 from prompt_strings import get_prompt_strings, strings
     
+@functools.lru_cache(maxsize=65536)
+def tag_text(text, spans, begin_tag, end_tag, sticked):
+    # spans is a tuple of (begin, end) offsets. Tags are inserted in one pass over the sorted offsets,
+    # the opening tags before the closing ones at a given offset. As when walking the text character
+    # by character, nothing is inserted at or after the end of the text.
+    opening = begin_tag + ('' if sticked else ' ')
+    closing = ('' if sticked else ' ') + end_tag
+    insertions = defaultdict(list)
+    for begin, _ in spans:
+        insertions[begin].append(opening)
+    for _, end in spans:
+        insertions[end].append(closing)
+    pieces = []
+    previous = 0
+    for offset in sorted(insertions):
+        if offset >= len(text):
+            break
+        pieces.append(text[previous:offset])
+        pieces.extend(insertions[offset])
+        previous = offset
+    pieces.append(text[previous:])
+    return ''.join(pieces)
+
 def example2string(example, ner_tag, begin_tag, end_tag, sticked, tagged, list_separator=", ", listing=False):
     if not listing:
         if not tagged:
             return example['text'].rstrip()
-        begins = [e['fragments'][0]['begin'] for e in example['entities'] if e['label'] == ner_tag]
-        ends = [e['fragments'][0]['end'] for e in example['entities'] if e['label'] == ner_tag]
-        res_text = ''
-        for i,c in enumerate(example['text']):
-            for _ in range(begins.count(i)):
-                res_text+=begin_tag + ('' if sticked else ' ')
-            for _ in range(ends.count(i)):
-                res_text+=('' if sticked else ' ') + end_tag
-            res_text+=c
-        return res_text.rstrip()
+        spans = tuple((e['fragments'][0]['begin'], e['fragments'][0]['end']) for e in example['entities'] if e['label'] == ner_tag)
+        return tag_text(example['text'], spans, begin_tag, end_tag, sticked).rstrip()
     else:
         if not tagged:
             return example['text'].rstrip()
@@ -26,27 +42,131 @@ def example2string(example, ner_tag, begin_tag, end_tag, sticked, tagged, list_s
         return list_separator.join(entities)
         
 
-def get_first_prompt_examples_for_all(train_dataset, test_dataset, ner_tag, n_few_shot, one_step, random_seed):
+def get_first_prompt_examples_for_all(train_dataset, test_dataset, ner_tag, n_few_shot, one_step, random_seed, retriever="tfidf", retriever_index_dir=None):
+    # If test_dataset is None, prompts are made for every training example, using the other ones as demonstrations.
     random.seed(random_seed)
-    num_prompts = len(test_dataset)
+    leave_one_out = test_dataset is None
+    num_prompts = len(train_dataset) if leave_one_out else len(test_dataset)
     few_shots_for_all = []
     def sentences_with_most_occurences(train_dataset, ner_tag, n):
         return sorted(range(len(train_dataset)), key=lambda i: len([ent for ent in train_dataset[i]['entities'] if ent['label'] == ner_tag]), reverse=True)[:n]
     if not one_step:
-        few_shots_for_all = [sentences_with_most_occurences(train_dataset, ner_tag, n_few_shot)] * num_prompts
+        if leave_one_out:
+            most_occurences = sentences_with_most_occurences(train_dataset, ner_tag, n_few_shot+1)
+            few_shots_for_all = [[j for j in most_occurences if j != i][:n_few_shot] for i in range(num_prompts)]
+        else:
+            few_shots_for_all = [sentences_with_most_occurences(train_dataset, ner_tag, n_few_shot)] * num_prompts
     else :
-        #get the k nearest sentences in the training set tf-idf wise
-        tfidf = TfidfVectorizer(tokenizer=lambda x: x, lowercase=False)
-        transformed_train = tfidf.fit_transform([e['text'] for e in train_dataset])
-        transformed_test = tfidf.transform([e['text'] for e in test_dataset])
-        similarities = cosine_similarity(transformed_test, transformed_train)
-        few_shots_for_all = [sorted(range(len(similarities[i])), key=lambda j: similarities[i][j])[-n_few_shot:] for i in range(num_prompts)]
+        #get the k nearest sentences in the training set, tf-idf wise by default
+        few_shots_for_all = get_retriever(train_dataset, retriever, index_dir=retriever_index_dir, random_seed=random_seed).query(test_dataset, n_few_shot)
     return few_shots_for_all
 
 def introduce(keywords, ner_tag, specialist_name):
     return keywords['task_introduction'].format(ner_tag_plural=keywords['ner_tags_names_in_plural'][ner_tag], ner_tag_description=keywords['ner_tags_description'][ner_tag], specialist=specialist_name)
 
+class DemonstrationCache:
+    # Size-bounded LRU cache of rendered demonstrations, with hit/miss counters.
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        self.entries[key] = render()
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return self.entries[key]
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} entries"
+
+demonstration_cache = DemonstrationCache()
+
+class DemonstrationPacker:
+    # Keeps, for each prompt, the most similar demonstrations whose tokens fit in max_tokens along with the rest
+    # of the prompt (all of them if max_tokens is None), and records the length of every prompt made.
+    # Lengths are counted with the prompt_encoder (a PromptEncoder) that tokenizes the prompts sent to the model,
+    # on their fragments as wrap_fragments turns them into the model's (e.g. adding its instruction template),
+    # so that they are the lengths actually sent and every fragment is tokenized once.
+    def __init__(self, prompt_encoder, max_tokens=None, wrap_fragments=None):
+        self.prompt_encoder = prompt_encoder
+        self.max_tokens = max_tokens
+        self.wrap_fragments = wrap_fragments or (lambda fragments: fragments)
+        self.prompt_lengths = []
+        self.dropped = 0
+
+    def pack(self, intro, question, few_shots, demonstrations):
+        # few_shots are the demonstration indices ordered from most to least similar, demonstrations their texts,
+        # which go between intro and question. Returns the kept indices, in the order of few_shots.
+        length = self.prompt_encoder.length(self.wrap_fragments((intro, question)))
+        kept = set()
+        for i, demonstration in zip(few_shots, demonstrations):
+            demonstration_length = len(self.prompt_encoder.encode_fragment(demonstration, first=False))
+            if self.max_tokens is None or length+demonstration_length <= self.max_tokens:
+                kept.add(i)
+                length += demonstration_length
+        self.dropped += len(few_shots)-len(kept)
+        self.prompt_lengths.append(length)
+        return [i for i in few_shots if i in kept]
+
+    def stats(self):
+        return f"prompt lengths in tokens {length_distribution(self.prompt_lengths)}; {self.dropped} demonstrations dropped to fit in {self.max_tokens} tokens"
+
+def length_distribution(lengths):
+    if not lengths:
+        return "(no prompt)"
+    lengths = sorted(lengths)
+    quantiles = ", ".join(f"{name} {lengths[min(int(q*len(lengths)), len(lengths)-1)]}" for name, q in [("min", 0.), ("median", .5), ("p90", .9), ("p99", .99), ("max", 1.)])
+    return f"over {len(lengths)} prompts: {quantiles}"
+
+class PromptEncoder:
+    # Token ids of prompts given as fragments that each end with a newline, e.g. the fragments returned by make_prompts.
+    # Fragments are tokenized once, as they are tokenized after a newline (or at the start of the text for the first one),
+    # and the ids of a prompt are the concatenation of those of its fragments, with the tokenizer's special tokens.
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.newline_ids = tokenizer.encode('\n', add_special_tokens=False)
+        self.fragment_ids = {}
+        #special tokens put around a text, read on the encoding of a newline as transformers 5 tokenizers
+        #no longer have build_inputs_with_special_tokens
+        newline_with_special = tokenizer.encode('\n')
+        start = next(k for k in range(len(newline_with_special)) if newline_with_special[k:k+len(self.newline_ids)] == self.newline_ids)
+        self.special_prefix = newline_with_special[:start]
+        self.special_suffix = newline_with_special[start+len(self.newline_ids):]
+
+    def encode_fragment(self, fragment, first):
+        if (fragment, first) not in self.fragment_ids:
+            if first:
+                self.fragment_ids[(fragment, first)] = self.tokenizer.encode(fragment, add_special_tokens=False)
+            else:
+                self.fragment_ids[(fragment, first)] = self.tokenizer.encode('\n'+fragment, add_special_tokens=False)[len(self.newline_ids):]
+        return self.fragment_ids[(fragment, first)]
+
+    def encode(self, fragments):
+        ids = []
+        for k, fragment in enumerate(fragments):
+            ids.extend(self.encode_fragment(fragment, k == 0))
+        return self.special_prefix+ids+self.special_suffix
+
+    def length(self, fragments):
+        n_special = len(self.special_prefix)+len(self.special_suffix)
+        return n_special+sum(len(self.encode_fragment(fragment, k == 0)) for k, fragment in enumerate(fragments))
+
 def demonstrate(example, ner_tag, begin_tag, end_tag, keywords, list_separator, listing):
+    #the same training sentence is demonstrated for many test sentences, tags and hyperparameter configurations.
+    #The key holds everything the rendering depends on: the example, identified by the object itself rather than by its
+    #text and annotations so that building the key costs nothing, the tag and the prompt strings variant. Entries keep
+    #their example alive, so that its id cannot be reused by another one while they are cached.
+    key = (id(example), ner_tag, begin_tag, end_tag, list_separator, listing, keywords['input_intro'], keywords['output_intro'])
+    return demonstration_cache.get(key, lambda: (example, render_demonstration(example, ner_tag, begin_tag, end_tag, keywords, list_separator, listing)))[1]
+
+def render_demonstration(example, ner_tag, begin_tag, end_tag, keywords, list_separator, listing):
     prompt = keywords['input_intro']+example2string(example, ner_tag, begin_tag, end_tag, sticked=True, tagged=False, list_separator=list_separator, listing=listing)+'\n'
     prompt+= keywords['output_intro']+example2string(example, ner_tag, begin_tag, end_tag, sticked=True, tagged=True, list_separator=list_separator, listing=listing)+'\n'
     return prompt
@@ -61,6 +181,7 @@ def ask(example, ner_tag, begin_tag, end_tag, keywords, list_separator, listing)
     return prompt
 
 def get_self_verif_examples(train_dataset, ner_tag, n_few_shot, begin_tag, end_tag, list_separator, listing):
+    # Returns the (sentence, entity, answer) examples, and the training examples they were taken from
     examples=[]
     #add positive examples
     if n_few_shot > len([e for e in train_dataset if ner_tag in [ent['label'] for ent in e['entities']] ]):
@@ -86,11 +207,25 @@ def get_self_verif_examples(train_dataset, ner_tag, n_few_shot, begin_tag, end_t
 
     #shuffle the examples
     random.shuffle(examples)
-    return examples
+    return examples, pos_examples+neg_examples
 
 def get_yes_no_words(prompt_language):
     return (strings[prompt_language]['yes_short'], strings[prompt_language]['no_short'])
 
+def get_answer_tokens(tokenizer, prompt, words):
+    # First token of each word as written right after prompt, a verification prompt as sent to the model.
+    # The answer starts a line after a plain prompt, and follows a space after an instruction template
+    # ("ASSISTANT:", "[/INST]"), where sentencepiece tokenizers give it a different token than at a line start.
+    prompt_ids = tokenizer.encode(prompt, add_special_tokens=False)
+    separator = '' if prompt[-1:].isspace() else ' '
+    answer_tokens = []
+    for word in words:
+        ids = tokenizer.encode(prompt+separator+word, add_special_tokens=False)
+        #the end of the prompt may merge with the answer into other tokens, the answer then starts where both differ
+        start = next((k for k, (a, b) in enumerate(zip(ids, prompt_ids)) if a != b), len(prompt_ids))
+        answer_tokens.append(ids[start])
+    return answer_tokens
+
 def make_prompts(
         train_dataset,
         test_dataset,
@@ -109,30 +244,70 @@ def make_prompts(
         prompt_ask,
         prompt_long_answer,
         prompt_dash,
+        retriever="tfidf",
+        retriever_index_dir=None,
+        demonstration_packer=None,
     ):
 
-    few_shots_for_all = get_first_prompt_examples_for_all(train_dataset, test_dataset, ner_tag, n_few_shot, one_step, random_seed)
+    few_shots_for_all = get_first_prompt_examples_for_all(train_dataset, test_dataset, ner_tag, n_few_shot, one_step, random_seed, retriever=retriever, retriever_index_dir=retriever_index_dir)
     keywords = get_prompt_strings(language=prompt_language, youre_a_specialist=prompt_youre_a_specialist, label_description=prompt_label_description, ask=prompt_ask, long_answer=prompt_long_answer, dash=prompt_dash, listing=listing)
 
+    leave_one_out = test_dataset is None
+    if leave_one_out:
+        test_dataset = train_dataset
+
+    #prompts start with a prefix shared by every prompt of this tag, so that its computation can be shared
+    shared_prefix = introduce(keywords, ner_tag, prompt_specialist_name)
+    #in two-step mode the demonstrations are the same for (almost) every sentence, so each distinct set is shuffled once and shared too
+    demonstration_prefixes = {}
     prompts = []
+    prefixes = []
+    #each prompt is also returned as the tuple of its fragments (intro, demonstrations, question), which all end with a newline but the last one
+    fragments = []
     for p in range(len(test_dataset)):
-        prompt=""
-        prompt+=introduce(keywords, ner_tag, prompt_specialist_name)
         few_shots= few_shots_for_all[p]
-        random.shuffle(few_shots)
-        for i in few_shots:
-            prompt+=demonstrate(train_dataset[i], ner_tag, begin_tag, end_tag, keywords, list_separator, listing)
-        prompt+=ask(test_dataset[p], ner_tag, begin_tag, end_tag, keywords, list_separator, listing)
-        prompts.append(prompt) 
+        question = ask(test_dataset[p], ner_tag, begin_tag, end_tag, keywords, list_separator, listing)
+        if demonstration_packer is not None:
+            #retrieved demonstrations come least similar first, the two-step ones most relevant first
+            by_similarity = few_shots[::-1] if one_step else few_shots
+            kept = demonstration_packer.pack(shared_prefix, question, by_similarity, [demonstrate(train_dataset[i], ner_tag, begin_tag, end_tag, keywords, list_separator, listing) for i in by_similarity])
+            few_shots = kept[::-1] if one_step else kept
+        if one_step:
+            prefix = shared_prefix
+            random.shuffle(few_shots)
+            prompt_fragments = (shared_prefix,)+tuple(demonstrate(train_dataset[i], ner_tag, begin_tag, end_tag, keywords, list_separator, listing) for i in few_shots)+(question,)
+        else:
+            if tuple(few_shots) not in demonstration_prefixes:
+                shuffled = list(few_shots)
+                random.shuffle(shuffled)
+                prefix_fragments = (shared_prefix,)+tuple(demonstrate(train_dataset[i], ner_tag, begin_tag, end_tag, keywords, list_separator, listing) for i in shuffled)
+                demonstration_prefixes[tuple(few_shots)] = ("".join(prefix_fragments), prefix_fragments)
+            prefix, prefix_fragments = demonstration_prefixes[tuple(few_shots)]
+            prompt_fragments = prefix_fragments+(question,)
+        prompts.append("".join(prompt_fragments))
+        prefixes.append(prefix)
+        fragments.append(prompt_fragments)
     
     if one_step:
-        return prompts, None
-    
-    self_verification_template = ""
-    self_verification_template+= keywords['task_introduction_self_verif'].format(ner_tag_sing=keywords['ner_tags_names'][ner_tag], ner_tag_description=keywords['ner_tags_description'][ner_tag], specialist=prompt_specialist_name)
-    examples = get_self_verif_examples(train_dataset, ner_tag, n_few_shot, begin_tag, end_tag, list_separator, listing)
-    for example, pred, label in examples:
-        self_verification_template+= keywords['self_verif_template'].format(ner_tag_sing=keywords['ner_tags_names'][ner_tag]).format(word=pred,sentence=example,)+keywords[label].format(word=pred, ner_tag_sing=keywords['ner_tags_names'][ner_tag])+"\n"
-    self_verification_template+= keywords['self_verif_template'].format(ner_tag_sing=keywords['ner_tags_names'][ner_tag])
-    
-    return prompts, self_verification_template
+        return prompts, prefixes, None, fragments
+
+    def make_self_verification_template(verif_dataset):
+        self_verification_template = ""
+        self_verification_template+= keywords['task_introduction_self_verif'].format(ner_tag_sing=keywords['ner_tags_names'][ner_tag], ner_tag_description=keywords['ner_tags_description'][ner_tag], specialist=prompt_specialist_name)
+        examples, used = get_self_verif_examples(verif_dataset, ner_tag, n_few_shot, begin_tag, end_tag, list_separator, listing)
+        for example, pred, label in examples:
+            self_verification_template+= keywords['self_verif_template'].format(ner_tag_sing=keywords['ner_tags_names'][ner_tag]).format(word=pred,sentence=example,)+keywords[label].format(word=pred, ner_tag_sing=keywords['ner_tags_names'][ner_tag])+"\n"
+        self_verification_template+= keywords['self_verif_template'].format(ner_tag_sing=keywords['ner_tags_names'][ner_tag])
+        return self_verification_template, used
+
+    #one self verification template per prompt. In leave-one-out mode, as for the first prompts, a sentence must not be
+    #an example of its own verification: the few sentences of the shared template get one made without them
+    self_verification_template, used = make_self_verification_template(train_dataset)
+    self_verification_templates = [self_verification_template]*len(test_dataset)
+    if leave_one_out:
+        used_ids = {id(example) for example in used}
+        for p, example in enumerate(train_dataset):
+            if id(example) in used_ids:
+                self_verification_templates[p], _ = make_self_verification_template([e for e in train_dataset if e is not example])
+
+    return prompts, prefixes, self_verification_templates, fragments
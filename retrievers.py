@@ -0,0 +1,143 @@
+import os
+import hashlib
+import joblib
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+
+
+def top_k(scores, k):
+    # Indices of the k highest scores, least similar first. Ties are broken like a stable ascending
+    # sort followed by [-k:], i.e. among equal scores the highest indices are kept and come last.
+    if k >= len(scores):
+        candidates = np.arange(len(scores))
+    else:
+        kth = np.partition(scores, len(scores)-k)[len(scores)-k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)
+        candidates = np.concatenate([above, ties[len(ties)-(k-len(above)):]])
+    return candidates[np.lexsort((candidates, scores[candidates]))].tolist()
+
+
+class Retriever:
+    # A retriever is built once on the training set, then queried for the indices of the n training examples
+    # most similar to each test example, least similar first. If test_dataset is None, every training example
+    # is queried against all the others (leave-one-out).
+    def query(self, test_dataset, n):
+        raise NotImplementedError
+
+
+class TfidfRetriever(Retriever):
+    def __init__(self, train_dataset, index_dir=None, random_seed=0, chunk_size=1024):
+        #fitting is cheap, so the tf-idf index is never persisted and index_dir is ignored, and it is deterministic
+        self.tfidf = TfidfVectorizer(tokenizer=lambda x: x, lowercase=False)
+        self.transformed_train = self.tfidf.fit_transform([e['text'] for e in train_dataset])
+        self.chunk_size = chunk_size
+
+    def query(self, test_dataset, n):
+        # Similarities are computed chunk by chunk so that the full test x train matrix is never materialized.
+        leave_one_out = test_dataset is None
+        transformed_test = self.transformed_train if leave_one_out else self.tfidf.transform([e['text'] for e in test_dataset])
+        if leave_one_out:
+            n = min(n, self.transformed_train.shape[0]-1)
+        if n <= 0:
+            return [[] for _ in range(transformed_test.shape[0])]
+        few_shots_for_all = []
+        for start in range(0, transformed_test.shape[0], self.chunk_size):
+            similarities = cosine_similarity(transformed_test[start:start+self.chunk_size], self.transformed_train)
+            if leave_one_out:
+                rows = np.arange(similarities.shape[0])
+                similarities[rows, rows+start] = -np.inf
+            few_shots_for_all.extend(top_k(row, n) for row in similarities)
+        return few_shots_for_all
+
+
+class IVFRetriever(Retriever):
+    # Approximate nearest neighbours over dense sentence embeddings (character n-gram TF-IDF reduced with a
+    # truncated SVD, computed on CPU). Training sentences are bucketed by their nearest k-means centroid and a
+    # query only scores the sentences of its n_probe nearest buckets. If index_dir is given, the index is saved
+    # there and later runs on the same training set and index settings memory-map it instead of rebuilding it.
+    TFIDF_OPTIONS = {'analyzer': 'char_wb', 'ngram_range': (2, 4), 'sublinear_tf': True}
+    KMEANS_N_INIT = 3
+
+    def __init__(self, train_dataset, index_dir=None, n_components=256, n_probe=8, random_seed=0):
+        texts = [e['text'] for e in train_dataset]
+        self.n_probe = n_probe
+        #n_probe only matters at query time, everything else that the index depends on is part of its path
+        settings = repr((n_components, random_seed, sorted(self.TFIDF_OPTIONS.items()), self.KMEANS_N_INIT))
+        path = os.path.join(index_dir, 'ivf_'+hashlib.sha1((settings+'\n'+'\n'.join(texts)).encode()).hexdigest()) if index_dir else None
+        if path is not None and os.path.exists(os.path.join(path, 'encoder.joblib')):
+            self.load(path)
+        else:
+            self.build(texts, n_components, random_seed)
+            if path is not None:
+                self.save(path)
+
+    def build(self, texts, n_components, random_seed):
+        tfidf = TfidfVectorizer(**self.TFIDF_OPTIONS)
+        transformed = tfidf.fit_transform(texts)
+        svd = TruncatedSVD(max(1, min(n_components, transformed.shape[0]-1, transformed.shape[1]-1)), random_state=random_seed)
+        self.embeddings = normalize(svd.fit_transform(transformed)).astype(np.float32)
+        self.encoder = (tfidf, svd)
+        kmeans = MiniBatchKMeans(n_clusters=max(1, int(np.sqrt(len(texts)))), random_state=random_seed, n_init=self.KMEANS_N_INIT).fit(self.embeddings)
+        self.centroids = kmeans.cluster_centers_.astype(np.float32)
+        #inverted lists, stored contiguously: the ids of bucket l are list_ids[list_offsets[l]:list_offsets[l+1]]
+        self.list_ids = np.argsort(kmeans.labels_, kind='stable')
+        self.list_offsets = np.searchsorted(kmeans.labels_[self.list_ids], np.arange(len(self.centroids)+1))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ['embeddings', 'centroids', 'list_ids', 'list_offsets']:
+            np.save(os.path.join(path, name+'.npy'), getattr(self, name))
+        #written last, its presence marks a complete index
+        joblib.dump(self.encoder, os.path.join(path, 'encoder.joblib'))
+
+    def load(self, path):
+        for name in ['embeddings', 'centroids', 'list_ids', 'list_offsets']:
+            setattr(self, name, np.load(os.path.join(path, name+'.npy'), mmap_mode='r'))
+        self.encoder = joblib.load(os.path.join(path, 'encoder.joblib'))
+
+    def embed(self, texts):
+        tfidf, svd = self.encoder
+        return normalize(svd.transform(tfidf.transform(texts))).astype(np.float32)
+
+    def query(self, test_dataset, n):
+        leave_one_out = test_dataset is None
+        queries = self.embeddings if leave_one_out else self.embed([e['text'] for e in test_dataset])
+        n = min(n, len(self.embeddings)-(1 if leave_one_out else 0))
+        if n <= 0:
+            return [[] for _ in range(len(queries))]
+        centroid_scores = queries @ self.centroids.T
+        few_shots_for_all = []
+        for q, query in enumerate(queries):
+            probes = np.argsort(-centroid_scores[q], kind='stable')
+            n_probe = self.n_probe
+            while True:
+                candidates = np.sort(np.concatenate([self.list_ids[self.list_offsets[l]:self.list_offsets[l+1]] for l in probes[:n_probe]]))
+                if leave_one_out:
+                    candidates = candidates[candidates != q]
+                #probe more buckets if the nearest ones do not hold enough sentences
+                if len(candidates) >= n or n_probe >= len(probes):
+                    break
+                n_probe *= 2
+            scores = self.embeddings[candidates] @ query
+            few_shots_for_all.append(candidates[top_k(scores, n)].tolist())
+        return few_shots_for_all
+
+
+RETRIEVERS = {
+    "tfidf": TfidfRetriever,
+    "ivf": IVFRetriever,
+}
+
+_retrievers = {}
+
+def get_retriever(train_dataset, name="tfidf", **options):
+    #the index only depends on the training texts and the options, so it is built once and reused across tags and runs
+    key = (name, tuple(sorted(options.items())), tuple(e['text'] for e in train_dataset))
+    if key not in _retrievers:
+        _retrievers[key] = RETRIEVERS[name](train_dataset, **options)
+    return _retrievers[key]
@@ -0,0 +1,25 @@
+import string
+
+import pytest
+import torch
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    # Character level tokenizer, built without downloading anything
+    transformers = pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, Regex, models, pre_tokenizers, decoders
+    vocab = {token: i for i, token in enumerate(["<pad>", "<s>", "</s>", "<unk>"]+list(string.printable))}
+    tok = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.Split(Regex(r"[\s\S]"), behavior="isolated")
+    tok.decoder = decoders.Fuse()
+    return transformers.PreTrainedTokenizerFast(tokenizer_object=tok, pad_token="<pad>", bos_token="<s>", eos_token="</s>", unk_token="<unk>", padding_side="left")
+
+
+@pytest.fixture(scope="session")
+def model(tokenizer):
+    # Tiny randomly initialized causal LM, in double precision so that batching does not change any argmax
+    transformers = pytest.importorskip("transformers")
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512, pad_token_id=tokenizer.pad_token_id, bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id)
+    return transformers.LlamaForCausalLM(config).double().eval()
@@ -0,0 +1,96 @@
+import copy
+
+import pytest
+import torch
+
+pytest.importorskip("transformers")
+
+from hf_generation import PrefixCache, constrained_generate, encode_batch_inputs, forward_new_tokens, greedy_generate, hf_answer_probabilities, hf_generate
+
+PROMPTS = ["Input: a cat\nOutput:", "Input: the dog barks loudly\nOutput:", "Input: x\nOutput:"]
+TEXTS = ["a cat", "the dog barks loudly", "x"]
+PREFIX = "Input:"
+
+
+@pytest.fixture(scope="module")
+def tagging_model(model, tokenizer):
+    # the random model, made to open and close tags often and never to stop early, so that outputs mix copied and tag tokens
+    tagging_model = copy.deepcopy(model)
+    weight = tagging_model.lm_head.weight.data
+    weight[tokenizer.convert_tokens_to_ids('@')] *= 0.2
+    weight[tokenizer.convert_tokens_to_ids('#')] *= 0.5
+    weight[tokenizer.eos_token_id] = 0.
+    return tagging_model
+
+
+def run_constrained(model, tokenizer, batch_size):
+    entries = tokenizer([text+'\n' for text in TEXTS], add_special_tokens=False).input_ids
+    return constrained_generate(
+        model,
+        tokenizer,
+        PROMPTS,
+        entries,
+        newline_token=tokenizer.convert_tokens_to_ids('\n'),
+        eos_token=tokenizer.eos_token_id,
+        begin_tag_toks=tokenizer.encode("@@", add_special_tokens=False),
+        end_tag_toks=tokenizer.encode("@##", add_special_tokens=False)[1:],
+        sticked=True,
+        batch_size=batch_size,
+        max_new_tokens=64,
+    )
+
+
+def test_constrained_generate_only_inserts_tags(tagging_model, tokenizer):
+    outputs = run_constrained(tagging_model, tokenizer, batch_size=8)
+    assert any("@@" in output for output in outputs)
+    for output, text in zip(outputs, TEXTS):
+        assert text.startswith(output.replace("@@", "").replace("##", ""))
+
+
+def test_constrained_generate_is_independent_of_batching(tagging_model, tokenizer):
+    # padded batches go through the cached decoding steps like single sentences
+    assert run_constrained(tagging_model, tokenizer, batch_size=8) == run_constrained(tagging_model, tokenizer, batch_size=1)
+
+
+def test_prefix_cache_gives_the_logits_of_plain_encoding(model, tokenizer):
+    prompts_ids = tokenizer(PROMPTS).input_ids
+    prefix_cache = PrefixCache(model, tokenizer)
+    for num_copies in [1, 2]:
+        input_ids, attention_mask, past_key_values = encode_batch_inputs(tokenizer, prefix_cache, prompts_ids, PREFIX, num_copies=num_copies)
+        assert past_key_values is not None
+        cached_logits, _ = forward_new_tokens(model, input_ids.repeat_interleave(num_copies, dim=0), attention_mask.repeat_interleave(num_copies, dim=0), past_key_values)
+        input_ids, attention_mask, _ = encode_batch_inputs(tokenizer, prefix_cache, prompts_ids)
+        logits, _ = forward_new_tokens(model, input_ids, attention_mask)
+        torch.testing.assert_close(cached_logits[:, -1], logits[:, -1].repeat_interleave(num_copies, dim=0))
+    # the stored prefix state is not extended by the batches built on it
+    assert prefix_cache.hits == 1 and prefix_cache.get(PREFIX)[1].get_seq_length() == len(PREFIX)
+
+
+def test_hf_generate_with_prefix_cache(model, tokenizer):
+    model_kwargs = {"num_beams": 2, "do_sample": False}
+    newline_token = tokenizer.convert_tokens_to_ids('\n')
+    prefix_cache = PrefixCache(model, tokenizer)
+    outputs, _ = hf_generate(model, tokenizer, PROMPTS, [PREFIX]*len(PROMPTS), prefix_cache, model_kwargs, newline_token, max_new_tokens=8)
+    assert prefix_cache.misses == 1
+    assert outputs == hf_generate(model, tokenizer, PROMPTS, None, prefix_cache, model_kwargs, newline_token, max_new_tokens=8)[0]
+
+
+def test_greedy_generate_matches_uncached_decoding(model, tokenizer):
+    newline_token = tokenizer.convert_tokens_to_ids('\n')
+    prompts_ids = tokenizer(PROMPTS).input_ids
+    prefix_cache = PrefixCache(model, tokenizer)
+    input_ids, attention_mask, past_key_values = encode_batch_inputs(tokenizer, prefix_cache, prompts_ids, PREFIX)
+    generated, _ = greedy_generate(model, input_ids, attention_mask, past_key_values, newline_token, tokenizer.eos_token_id, max_new_tokens=12)
+    for ids, output in zip(prompts_ids, generated):
+        expected = []
+        while len(expected) < 12 and (not expected or expected[-1] not in [newline_token, tokenizer.eos_token_id]):
+            expected.append(model(torch.tensor([ids+expected])).logits[0, -1].argmax().item())
+        assert output == expected
+
+
+def test_hf_answer_probabilities_match_uncached_scoring(model, tokenizer):
+    answer_tokens = tokenizer.convert_tokens_to_ids(['Y', 'N'])
+    probabilities = hf_answer_probabilities(model, tokenizer, PROMPTS, [PREFIX]*len(PROMPTS), PrefixCache(model, tokenizer), answer_tokens)
+    for prompt, probability in zip(PROMPTS, probabilities):
+        logits = model(tokenizer(prompt, return_tensors="pt").input_ids).logits[0, -1, answer_tokens]
+        assert probability == pytest.approx(logits.softmax(-1)[0].item())
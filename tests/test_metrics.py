@@ -0,0 +1,169 @@
+import multiprocessing
+import random
+
+import pytest
+
+pytest.importorskip("nlstruct")
+pytest.importorskip("torchmetrics")
+
+from nlstruct_extensions import DocumentEntityMetricPerLabel, WordOffsetsCache
+
+WORDS = "le chat noir mange la souris grise , . ; l'homme aujourd'hui Paris New-York 3,5 mg/j ( ) - é à".split()
+LABELS = ["PER", "LOC", "ORG", "MISC"]
+THRESHOLDS = [1., 1e-5, 0.5]
+
+# (true positives, pred count, gold count) overall and by label on make_corpus(0), as counted by the metric before the
+# fast matching path, the multi-threshold states and the word cache were added (per-document tensor matching on CUDA)
+BASELINE_COUNTS = {
+    1.: {"": (228, 505, 439), "PER": (76, 167, 151), "LOC": (77, 177, 150), "ORG": (75, 161, 138)},
+    1e-5: {"": (300, 505, 439), "PER": (102, 167, 151), "LOC": (103, 177, 150), "ORG": (95, 161, 138)},
+    0.5: {"": (288, 505, 439), "PER": (98, 167, 151), "LOC": (98, 177, 150), "ORG": (92, 161, 138)},
+}
+
+
+def random_span(r, text):
+    begin = r.randrange(0, len(text)-1)
+    return begin, r.randint(begin+1, min(len(text), begin+15))
+
+
+def make_gold(r, doc_id):
+    text = " ".join(r.choice(WORDS) for _ in range(r.randint(1, 40)))
+    entities = []
+    for k in range(r.randint(0, 6) if len(text) >= 2 else 0):
+        #some entities have two fragments, which only the tensor matcher handles
+        fragments = [dict(zip(("begin", "end"), random_span(r, text))) for _ in range(1 if r.random() < 0.85 else 2)]
+        entities.append({"entity_id": f"T{k}", "label": r.choice(LABELS), "fragments": fragments, "text": text[fragments[0]["begin"]:fragments[0]["end"]]})
+    return {"doc_id": str(doc_id), "text": text, "entities": entities}
+
+
+def make_pred(r, gold):
+    # Keeps, shifts, relabels or drops each gold entity, sometimes twice (duplicate spans),
+    # and adds spurious entities, which may overlap and conflict with the others
+    text = gold["text"]
+    entities = []
+    for entity in gold["entities"]:
+        x = r.random()
+        if x < 0.4:
+            entities.append(dict(entity))
+        elif x < 0.6:
+            fragment = entity["fragments"][0]
+            begin = max(0, min(len(text)-1, fragment["begin"]+r.randint(-4, 4)))
+            end = max(begin+1, min(len(text), fragment["end"]+r.randint(-4, 4)))
+            entities.append({**entity, "fragments": [{"begin": begin, "end": end}]})
+        elif x < 0.75:
+            entities.append({**entity, "label": r.choice(LABELS)})
+        if r.random() < 0.1:
+            entities.append(dict(entity))
+    for k in range(r.randint(0, 2) if len(text) >= 2 else 0):
+        begin, end = random_span(r, text)
+        entities.append({"entity_id": f"P{k}", "label": r.choice(LABELS), "fragments": [{"begin": begin, "end": end}], "text": text[begin:end]})
+    return {"doc_id": gold["doc_id"], "text": text, "entities": entities}
+
+
+def make_corpus(seed, n=200):
+    r = random.Random(seed)
+    golds = [make_gold(r, i) for i in range(n)]
+    return [make_pred(r, gold) for gold in golds], golds
+
+
+def as_floats(results):
+    # results of compute(), nested by threshold name with several thresholds
+    return {name: as_floats(value) if isinstance(value, dict) else float(value) for name, value in results.items()}
+
+
+def make_metric(binarize_tag_threshold, **kwargs):
+    return DocumentEntityMetricPerLabel(binarize_tag_threshold=binarize_tag_threshold, binarize_label_threshold=1., add_label_specific_metrics=LABELS[:3], filter_entities=LABELS[:3], **kwargs)
+
+
+def evaluate(preds, golds, binarize_tag_threshold, **kwargs):
+    metric = make_metric(binarize_tag_threshold, **kwargs)
+    metric.start_workers()
+    try:
+        metric.update(preds, golds)
+        return as_floats(metric.compute())
+    finally:
+        metric.close()
+
+
+def count_states(metric, threshold_name=""):
+    return {
+        label: tuple(int(getattr(metric, metric.state_name(threshold_name, f"{label}_{counter}" if label else counter))) for counter in ["true_positive", "pred_count", "gold_count"])
+        for label in [""]+LABELS[:3]
+    }
+
+
+@pytest.mark.parametrize("fast_matching", [True, False])
+@pytest.mark.parametrize("threshold", THRESHOLDS)
+def test_counts_match_the_baseline_metric(threshold, fast_matching):
+    # on CPU, where the baseline metric could not run
+    preds, golds = make_corpus(0)
+    metric = make_metric(threshold, fast_matching=fast_matching, device="cpu")
+    metric.update(preds, golds)
+    assert metric.true_positive.device.type == "cpu"
+    assert count_states(metric) == BASELINE_COUNTS[threshold]
+
+
+@pytest.mark.parametrize("seed", range(1, 6))
+@pytest.mark.parametrize("threshold", THRESHOLDS)
+def test_fast_matching_matches_tensor_matching(seed, threshold):
+    preds, golds = make_corpus(seed)
+    assert evaluate(preds, golds, threshold) == evaluate(preds, golds, threshold, fast_matching=False)
+
+
+@pytest.mark.parametrize("threshold", THRESHOLDS)
+def test_fast_matching_resolves_conflicts_like_tensor_matching(threshold):
+    # predictions competing for the same gold entities: duplicates, nested and overlapping spans, other labels
+    text = "John Smith met Mary Jane Watson in New York"
+    def entity(begin, end, label):
+        return {"label": label, "fragments": [{"begin": begin, "end": end}], "text": text[begin:end]}
+    gold = {"doc_id": "0", "text": text, "entities": [entity(0, 10, "PER"), entity(15, 31, "PER"), entity(35, 43, "LOC")]}
+    pred = {"doc_id": "0", "text": text, "entities": [
+        entity(0, 4, "PER"), entity(0, 10, "PER"), entity(0, 10, "PER"), entity(5, 10, "PER"),
+        entity(15, 24, "PER"), entity(20, 31, "PER"), entity(15, 31, "LOC"),
+        entity(35, 38, "LOC"), entity(35, 43, "ORG"), entity(31, 43, "LOC"),
+    ]}
+    assert evaluate([pred], [gold], threshold) == evaluate([pred], [gold], threshold, fast_matching=False)
+
+
+@pytest.mark.parametrize("fast_matching", [True, False])
+def test_thresholds_counted_in_one_pass_match_separate_metrics(fast_matching):
+    preds, golds = make_corpus(1)
+    thresholds = {"exact": 1., "partial": 1e-5, "half": 0.5}
+    results = evaluate(preds, golds, thresholds, fast_matching=fast_matching)
+    assert results == {name: evaluate(preds, golds, threshold, fast_matching=fast_matching) for name, threshold in thresholds.items()}
+
+
+def test_shared_word_cache_gives_the_same_results():
+    preds, golds = make_corpus(2)
+    word_cache = WordOffsetsCache(make_metric(1.).word_regex)
+    word_cache.add(golds)
+    n_cached = len(word_cache.offsets)
+    for threshold in THRESHOLDS:
+        assert evaluate(preds, golds, threshold, word_cache=word_cache) == evaluate(preds, golds, threshold)
+    # every reference text was tokenized ahead, the evaluations added nothing
+    assert len(word_cache.offsets) == n_cached
+
+
+@pytest.mark.parametrize("seed", range(2))
+def test_workers_count_like_a_serial_update(seed):
+    preds, golds = make_corpus(seed)
+    thresholds = {"exact": 1., "partial": 1e-5, "half": 0.5}
+    assert evaluate(preds, golds, thresholds, n_workers=3) == evaluate(preds, golds, thresholds)
+
+
+def test_workers_start_once_and_close_without_children():
+    metric = DocumentEntityMetricPerLabel(binarize_tag_threshold=1., n_workers=2)
+    metric.start_workers()
+    pool = metric.pool
+    assert len(multiprocessing.active_children()) == 2
+    metric.start_workers()
+    assert metric.pool is pool and len(multiprocessing.active_children()) == 2
+    metric.close()
+    assert metric.pool is None and multiprocessing.active_children() == []
+
+
+def test_fractional_scores_stay_serial():
+    metric = DocumentEntityMetricPerLabel(binarize_tag_threshold=False, n_workers=2)
+    with pytest.warns(UserWarning, match="serial"):
+        metric.start_workers()
+    assert metric.pool is None and multiprocessing.active_children() == []
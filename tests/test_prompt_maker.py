@@ -0,0 +1,61 @@
+import copy
+
+import pytest
+
+pytest.importorskip("transformers")
+
+from prompt_maker import PromptEncoder, demonstrate, demonstration_cache, get_answer_tokens
+
+
+@pytest.fixture(scope="module")
+def sentencepiece_tokenizer():
+    # Word level tokenizer marking the words that follow a space with "▁" like sentencepiece ones, while a word
+    # starting a line has no marker
+    import transformers
+    from tokenizers import Tokenizer, Regex, models, pre_tokenizers, decoders
+    words = ["<unk>", "\n", "Is", "▁Is", "▁it", "▁a", "▁name?", "USER:", "▁ASSISTANT:", "[INST]", "▁[/INST]", "Yes", "No", "▁Yes", "▁No"]
+    tok = Tokenizer(models.WordLevel({word: i for i, word in enumerate(words)}, unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.Sequence([pre_tokenizers.Split(Regex("\n"), behavior="isolated"), pre_tokenizers.Metaspace(prepend_scheme="never")])
+    tok.decoder = decoders.Metaspace(prepend_scheme="never")
+    return transformers.PreTrainedTokenizerFast(tokenizer_object=tok, unk_token="<unk>")
+
+
+@pytest.mark.parametrize("prompt, answers", [
+    ("Is it a name?\n", ["Yes", "No"]),
+    ("USER: Is it a name?\n ASSISTANT:", ["▁Yes", "▁No"]),
+    ("[INST] Is it a name?\n [/INST]", ["▁Yes", "▁No"]),
+])
+def test_answer_tokens_follow_the_prompt_end(sentencepiece_tokenizer, prompt, answers):
+    assert get_answer_tokens(sentencepiece_tokenizer, prompt, ["Yes", "No"]) == sentencepiece_tokenizer.convert_tokens_to_ids(answers)
+
+
+@pytest.fixture(scope="module")
+def bos_tokenizer(tokenizer):
+    # the character level tokenizer, starting every text with <s> like Llama tokenizers
+    import transformers
+    from tokenizers import processors
+    backend = copy.deepcopy(tokenizer.backend_tokenizer)
+    backend.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", tokenizer.bos_token_id)])
+    return transformers.PreTrainedTokenizerFast(tokenizer_object=backend, pad_token="<pad>", bos_token="<s>", eos_token="</s>", unk_token="<unk>")
+
+
+@pytest.mark.parametrize("tokenizer_fixture", ["tokenizer", "bos_tokenizer"])
+def test_prompt_encoder_matches_whole_tokenization(request, tokenizer_fixture):
+    tokenizer = request.getfixturevalue(tokenizer_fixture)
+    fragments = ("Demonstration\n", "Is \"x\" a name? Yes\n", "In the sentence \"a cat\", is \"cat\" a name?\n")
+    prompt_encoder = PromptEncoder(tokenizer)
+    assert prompt_encoder.encode(fragments) == tokenizer("".join(fragments)).input_ids
+    assert prompt_encoder.length(fragments) == len(tokenizer("".join(fragments)).input_ids)
+
+
+def test_demonstrations_are_rendered_once_per_example():
+    keywords = {"input_intro": "Input: ", "output_intro": "Output: "}
+    entity = {"label": "PER", "fragments": [{"begin": 0, "end": 4}], "text": "John"}
+    example = {"doc_id": "0", "text": "John eats", "entities": [entity]}
+    #same id and text, other annotations
+    relabeled = {"doc_id": "0", "text": "John eats", "entities": [{**entity, "label": "LOC"}]}
+    misses = demonstration_cache.misses
+    first = demonstrate(example, "PER", "@@", "##", keywords, ", ", False)
+    assert demonstrate(example, "PER", "@@", "##", keywords, ", ", False) == first
+    assert demonstration_cache.misses == misses+1
+    assert "@@John##" in first and "@@" not in demonstrate(relabeled, "PER", "@@", "##", keywords, ", ", False)